@@ -0,0 +1,82 @@
+import os
+import time
+from dataclasses import dataclass
+
+AGGREGATE_STALE = float(os.getenv("AGGREGATE_STALE", "300"))
+AGGREGATE_ALPHA = float(os.getenv("AGGREGATE_ALPHA", "1.0"))
+AGGREGATE_HYSTERESIS = int(os.getenv("AGGREGATE_HYSTERESIS", "1"))
+AGGREGATE_DEFAULT_RULE = os.getenv("AGGREGATE_DEFAULT_RULE", "sum")
+
+COMBINE_RULES = {
+    # Камеры смотрят на непересекающиеся зоны — свободные места складываются
+    "sum": lambda values: sum(values),
+    # Камеры смотрят на одну и ту же зону с разных точек
+    "max": lambda values: max(values),
+    "min": lambda values: min(values),
+    "mean": lambda values: sum(values) / len(values),
+}
+
+
+@dataclass
+class CameraReading:
+    parking_lot_id: int
+    free: float
+    updated_at: float
+
+
+class LotAggregator:
+    """
+    Keeps the latest free_spots reported by every camera and combines them per
+    parking lot. Readings can be smoothed with an exponential moving average
+    (`alpha` < 1), and readings older than `stale` seconds are left out so a
+    dead camera doesn't pin the lot's value.
+    """
+
+    def __init__(self, alpha: float = AGGREGATE_ALPHA, stale: float = AGGREGATE_STALE):
+        self.alpha = alpha
+        self.stale = stale
+        self.readings: dict[int, CameraReading] = {}
+        self.by_lot: dict[int, set[int]] = {}
+
+    def update(self, camera_id: int, parking_lot_id: int, free: int, rule: str = None) -> int:
+        now = time.time()
+        reading = self.readings.get(camera_id)
+        if reading is not None and reading.parking_lot_id != parking_lot_id:
+            # Камеру перевесили на другую стоянку
+            self.forget(camera_id)
+            reading = None
+        if reading is None or now - reading.updated_at > self.stale:
+            value = float(free)
+        else:
+            value = self.alpha * free + (1 - self.alpha) * reading.free
+        self.readings[camera_id] = CameraReading(parking_lot_id, value, now)
+        self.by_lot.setdefault(parking_lot_id, set()).add(camera_id)
+        return self.combined(parking_lot_id, rule, now)
+
+    def combined(self, parking_lot_id: int, rule: str = None, now: float = None) -> int:
+        now = now or time.time()
+        values = [
+            self.readings[camera_id].free
+            for camera_id in self.by_lot.get(parking_lot_id, ())
+            if now - self.readings[camera_id].updated_at <= self.stale
+        ]
+        if not values:
+            return 0
+        combine = COMBINE_RULES.get(rule or AGGREGATE_DEFAULT_RULE, COMBINE_RULES["sum"])
+        return max(round(combine(values)), 0)
+
+    def forget(self, camera_id: int):
+        reading = self.readings.pop(camera_id, None)
+        if reading is not None:
+            self.by_lot.get(reading.parking_lot_id, set()).discard(camera_id)
+
+    def stats(self):
+        return {"cameras": len(self.readings), "lots": sum(1 for cameras in self.by_lot.values() if cameras)}
+
+
+lot_aggregator = LotAggregator()
+
+
+def significant(current: int, combined: int, hysteresis: int = AGGREGATE_HYSTERESIS):
+    # Шум в пару мест не должен порождать запись в БД и пуш клиентам
+    return current is None or abs(combined - current) >= max(hysteresis, 1)
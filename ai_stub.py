@@ -0,0 +1,59 @@
+"""
+Local stand-in for the AI server, for development and benchmarks.
+
+    AI_STUB_DELAY=0.05 uvicorn ai_stub:app --port 8001
+    AI_SERVER_URL=http://127.0.0.1:8001/ uvicorn main:app
+
+Answers like the real server. If AI_STUB_CALLBACK_URL is set it also posts
+the result back to /receive-image, as the real server does.
+"""
+import asyncio
+import os
+import random
+import time
+
+from typing import Optional
+
+import httpx
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile, status
+
+AI_STUB_DELAY = float(os.getenv("AI_STUB_DELAY", "0.05"))
+AI_STUB_FAIL_RATE = float(os.getenv("AI_STUB_FAIL_RATE", "0"))
+AI_STUB_CALLBACK_URL = os.getenv("AI_STUB_CALLBACK_URL", "")
+AI_SERVER_KEY = os.getenv("AI_SERVER_KEY", "")
+MAIN_SERVER_KEY = os.getenv("MAIN_SERVER_KEY", "")
+
+app = FastAPI()
+client = httpx.AsyncClient()
+
+
+@app.post("/")
+async def detect(token: str = Form(...), camera_id: int = Form(...), config: str = Form("{}"),
+                 image: UploadFile = File(...), seq: Optional[int] = Form(None)):
+    if AI_SERVER_KEY and token != AI_SERVER_KEY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tokens didn't match")
+    if random.random() < AI_STUB_FAIL_RATE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="stub failure")
+
+    started = time.perf_counter()
+    contents = await image.read()
+    await asyncio.sleep(AI_STUB_DELAY)
+    occupied = random.randint(0, 50)
+    free = 50 - occupied
+    processing_time = time.perf_counter() - started
+
+    if AI_STUB_CALLBACK_URL:
+        await client.post(
+            AI_STUB_CALLBACK_URL,
+            data={
+                "free": free,
+                "occupied": occupied,
+                "processing_time": processing_time,
+                "camera_id": camera_id,
+                "token": MAIN_SERVER_KEY,
+                **({"seq": seq} if seq is not None else {}),
+            },
+            files={"image": (f"camera_{camera_id}.jpg", contents, "image/jpeg")},
+        )
+
+    return {"free": free, "occupied": occupied, "processing_time": processing_time, "size": len(contents)}
@@ -2,14 +2,13 @@ from datetime import timedelta, datetime
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from db_main import SessionLocal
 from models import Users
-from passlib.context import CryptContext
 import bcrypt
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from jose import jwt, JWTError
 
 from dotenv import load_dotenv
 import os
@@ -21,13 +20,15 @@ class SolveBugBcryptWarning:
 
 setattr(bcrypt, "__about__", SolveBugBcryptWarning())
 
+from passwords import password_hasher
+from tokens import token_cache, encode_token, InvalidToken
+
 router = APIRouter(prefix='/auth', tags=['auth'])
 
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = 'HS256'
 
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
 
 class CreateUserRequest(BaseModel):
@@ -39,49 +40,43 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate user")
-    token = create_access_token(user.username, user.id, timedelta(minutes=20))
+    token = create_access_token(user.username, user.id, timedelta(minutes=20), user.is_superior, user.token_version or 0)
 
     return {'access_token': token, 'token_type': 'bearer'}
 
-def authenticate_user(username: str, password: str, db):
-    user = db.query(Users).filter(Users.username == username).first()
+async def authenticate_user(username: str, password: str, db):
+    user = await db.scalar(select(Users).where(Users.username == username))
     if not user:
         return False
-    if not bcrypt_context.verify(password, user.hashed_password):
+    # Соединение с БД не нужно на время проверки пароля, отдаём его обратно в пул
+    await db.close()
+    if not await password_hasher.check_login(username, password, user.hashed_password):
         return False
     return user
 
-def create_access_token(username: str, user_id: int, expires_delta: timedelta):
-    encode = {'sub': username, 'id': user_id}
+def create_access_token(username: str, user_id: int, expires_delta: timedelta, is_superior: bool = False, version: int = 0):
+    encode = {'sub': username, 'id': user_id, 'sup': bool(is_superior), 'ver': version}
     expires = datetime.utcnow() + expires_delta
     encode.update({'exp': expires})
-    return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encode_token(encode, SECRET_KEY, ALGORITHM)
 
 @router.get("/me")
 async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get('sub')
-        user_id: int = payload.get('id')
-        if username is None or user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user')
-    
-        return {'username': username, 'id': user_id}
-    except JWTError:
+        # Проверенные токены кэшируются до exp, роль и версия зашиты в сам токен
+        return await token_cache.validate(token, SECRET_KEY, ALGORITHM)
+    except InvalidToken:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user')
     
 user_dependency = Annotated[dict, Depends(get_current_user)]
@@ -89,19 +84,18 @@ user_dependency = Annotated[dict, Depends(get_current_user)]
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_user(db: db_dependency, create_user_request: CreateUserRequest, user: user_dependency):
-    cur = db.query(Users).filter(Users.id == user["id"]).first()
-    if not cur.is_superior and db.query(Users).count() > 0:
+    if not user["is_superior"] and await db.scalar(select(func.count()).select_from(Users)) > 0:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Do not have permission")
-    create_user_model = Users(username=create_user_request.username, hashed_password=bcrypt_context.hash(create_user_request.password), is_superior=create_user_request.is_superior)
+    create_user_model = Users(username=create_user_request.username, hashed_password=await password_hasher.hash(create_user_request.password), is_superior=create_user_request.is_superior)
 
     db.add(create_user_model)
-    db.commit()
+    await db.commit()
 
 @router.post("/create_admin", status_code=status.HTTP_201_CREATED)
 async def create_user(db: db_dependency, create_user_request: CreateUserRequest):
-    if db.query(Users).count() > 0:
+    if await db.scalar(select(func.count()).select_from(Users)) > 0:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Do not have permission")
-    create_user_model = Users(username=create_user_request.username, hashed_password=bcrypt_context.hash(create_user_request.password), is_superior=create_user_request.is_superior)
+    create_user_model = Users(username=create_user_request.username, hashed_password=await password_hasher.hash(create_user_request.password), is_superior=create_user_request.is_superior)
 
     db.add(create_user_model)
-    db.commit()
+    await db.commit()
@@ -0,0 +1,267 @@
+import csv
+import io
+import json
+import os
+from collections import deque
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+
+import crud
+import models
+from camera_cache import ConfigField
+from db_main import begin_for_savepoints
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_WRITE_SIZE = 64 * 1024
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+# Поля обязательны, но, как и колонки, допускают null: экспорт должен загружаться обратно как есть
+class ParkingLotItem(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    location_name: Optional[str]
+    free_spots: Optional[int]
+    capacity: Optional[int]
+
+
+class CameraItem(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str]
+    parking_lot_id: Optional[int]
+    api: Optional[str]
+    config: Optional[ConfigField]
+
+
+def item_errors(e: ValidationError):
+    return [{"loc": list(error["loc"]), "msg": error["msg"]} for error in e.errors(include_url=False)]
+
+
+async def read_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def read_items(request: Request):
+    """
+    Yields (index, item) from a JSON array, NDJSON or CSV body (by
+    Content-Type). NDJSON and CSV are parsed record by record as the body
+    arrives (a quoted CSV field may span lines); an unparsable record yields
+    a ValueError as its item. An empty CSV cell is null, the way
+    export_response writes it.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type == "text/csv":
+        # Один csv.reader на всё тело: поле в кавычках может содержать перевод строки.
+        # Строки копятся, пока кавычек нечётное число (запись не закончена), и только потом читаются
+        lines = deque()
+        reader = csv.reader(iter(lines.popleft, None))
+        quotes = 0
+        header = None
+        index = 0
+        async for line in read_lines(request):
+            try:
+                line = line.decode("utf-8-sig").rstrip("\r")
+            except UnicodeDecodeError as e:
+                yield index, ValueError(f"invalid UTF-8: {e}")
+                index += 1
+                lines.clear()
+                quotes = 0
+                continue
+            if not lines and not line.strip():
+                continue
+            lines.append(line + "\n")
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            quotes = 0
+            values = next(reader)
+            if header is None:
+                header = values
+                continue
+            yield index, {key: None if value == "" else value for key, value in zip(header, values)}
+            index += 1
+        if lines:
+            yield index, ValueError("unterminated quoted field")
+    elif content_type in NDJSON_TYPES:
+        index = 0
+        async for line in read_lines(request):
+            if not line.strip():
+                continue
+            try:
+                yield index, json.loads(line)
+            except ValueError as e:
+                yield index, ValueError(f"invalid JSON: {e}")
+            index += 1
+    else:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="body must be a JSON array")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="body must be a JSON array")
+        for index, item in enumerate(items):
+            yield index, item
+
+
+async def write_batch(batch, upsert, db, ids, errors):
+    try:
+        async with db.begin_nested():
+            written = await upsert([row for _, row in batch], db)
+    except SQLAlchemyError:
+        # Пачка не прошла (дубликат api, битый внешний ключ) — ищем виновные строки по одной
+        for index, row in batch:
+            try:
+                async with db.begin_nested():
+                    written = await upsert([row], db)
+            except SQLAlchemyError as e:
+                errors.append({"index": index, "detail": str(getattr(e, "orig", None) or e)})
+            else:
+                ids[index] = written[0]
+        return
+    for (index, _), row_id in zip(batch, written):
+        ids[index] = row_id
+
+
+async def bulk_upsert(request: Request, schema, upsert, db, atomic: bool = False):
+    """
+    Creates items without "id" and upserts items with one, in batches of
+    multi-row statements inside a single transaction. Invalid items are
+    reported by index and skipped; with `atomic` any error rolls back the
+    whole request.
+    """
+    ids = []
+    errors = []
+    batch = []
+    await begin_for_savepoints(db)
+    async for index, item in read_items(request):
+        ids.append(None)
+        if isinstance(item, Exception):
+            errors.append({"index": index, "detail": str(item)})
+            continue
+        try:
+            row = schema.model_validate(item).model_dump()
+        except ValidationError as e:
+            errors.append({"index": index, "detail": item_errors(e)})
+            continue
+        batch.append((index, row))
+        if len(batch) >= BULK_BATCH_SIZE:
+            await write_batch(batch, upsert, db, ids, errors)
+            batch = []
+    if batch:
+        await write_batch(batch, upsert, db, ids, errors)
+    errors.sort(key=lambda error: error["index"])
+    if atomic and errors:
+        await db.rollback()
+        raise HTTPException(status_code=422, detail={"errors": errors})
+    await db.commit()
+    return {"count": len(ids), "written": len(ids) - len(errors), "ids": ids, "errors": errors}
+
+
+async def bulk_upsert_parking_lots(request: Request, db, atomic: bool = False):
+    result = await bulk_upsert(request, ParkingLotItem, crud.upsert_parking_lots, db, atomic)
+    crud.forget_parking_lots([row_id for row_id in result["ids"] if row_id is not None])
+    return result
+
+
+async def bulk_upsert_cameras(request: Request, db, atomic: bool = False):
+    apis = set()
+
+    async def upsert(rows, db):
+        apis.update(row["api"] for row in rows)
+        return await crud.upsert_rows(models.Cameras, rows, db)
+
+    result = await bulk_upsert(request, CameraItem, upsert, db, atomic)
+    crud.forget_cameras([row_id for row_id in result["ids"] if row_id is not None], apis)
+    return result
+
+
+async def delete_batch(model, batch, db, deleted, errors):
+    try:
+        async with db.begin_nested():
+            deleted += await crud.delete_rows(model, [row_id for _, row_id in batch], db)
+        return
+    except SQLAlchemyError:
+        pass
+    # На строку ещё ссылаются (камеры удаляемой стоянки) — удаляем по одной, остальные проходят
+    for index, row_id in batch:
+        try:
+            async with db.begin_nested():
+                deleted += await crud.delete_rows(model, [row_id], db)
+        except SQLAlchemyError as e:
+            errors.append({"index": index, "id": row_id, "status": 409,
+                           "detail": str(getattr(e, "orig", None) or e)})
+
+
+async def bulk_delete(request: Request, model, forget, db):
+    # Принимает id числами или объектами {"id": ...}
+    ids = []
+    errors = []
+    async for index, item in read_items(request):
+        if isinstance(item, dict):
+            item = item.get("id")
+        try:
+            ids.append((index, int(item)))
+        except (TypeError, ValueError):
+            errors.append({"index": index, "detail": "id must be an integer"})
+    deleted = []
+    await begin_for_savepoints(db)
+    for i in range(0, len(ids), BULK_BATCH_SIZE):
+        await delete_batch(model, ids[i:i + BULK_BATCH_SIZE], db, deleted, errors)
+    await db.commit()
+    forget(deleted)
+    found = set(deleted)
+    failed = {error["id"] for error in errors if "id" in error}
+    errors.sort(key=lambda error: error["index"])
+    return {"deleted": deleted, "missing": [row_id for _, row_id in ids if row_id not in found and row_id not in failed],
+            "errors": errors}
+
+
+async def csv_rows(rows):
+    out = io.StringIO()
+    writer = None
+    async for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(out, fieldnames=list(row))
+            writer.writeheader()
+        # None пишется пустой ячейкой, read_items читает её обратно как null
+        writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in row.items()})
+        if out.tell() >= BULK_WRITE_SIZE:
+            yield out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode()
+
+
+async def ndjson_rows(rows):
+    chunk = bytearray()
+    async for row in rows:
+        chunk += json.dumps(row, separators=(",", ":"), default=str).encode() + b"\n"
+        if len(chunk) >= BULK_WRITE_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+    yield bytes(chunk)
+
+
+def export_response(rows, format: str, name: str):
+    if format == "csv":
+        body, media_type = csv_rows(rows), "text/csv"
+    elif format == "ndjson":
+        body, media_type = ndjson_rows(rows), "application/x-ndjson"
+    else:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    return StreamingResponse(body, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'})
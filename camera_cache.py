@@ -0,0 +1,128 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+from pydantic import Json
+from sqlalchemy import select
+
+import models
+
+CAMERA_CACHE_TTL = float(os.getenv("CAMERA_CACHE_TTL", "300"))
+CAMERA_CACHE_SIZE = int(os.getenv("CAMERA_CACHE_SIZE", "10000"))
+
+
+# Конфиг камеры в API: объект или, как раньше, строка с JSON-объектом
+ConfigField = Union[dict[str, Any], Json[dict[str, Any]]]
+
+
+def camera_config(config) -> dict:
+    # В колонке лежит объект; строку разбираем на случай значений не из БД
+    if isinstance(config, str):
+        try:
+            config = json.loads(config)
+        except ValueError:
+            return {}
+    return config if isinstance(config, dict) else {}
+
+
+@dataclass
+class CameraEntry:
+    id: int
+    parking_lot_id: Optional[int]
+    api: str
+    config: Any
+    options: dict
+    loaded_at: float
+
+
+class CameraCache:
+    """
+    Read-through cache of camera -> parking lot mapping and config.
+    Entries are stored by camera id, with a secondary index by API token.
+    Old entries expire after `ttl` seconds; least recently used are evicted
+    once `max_size` is reached.
+    """
+
+    def __init__(self, ttl: float = CAMERA_CACHE_TTL, max_size: int = CAMERA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[int, CameraEntry] = OrderedDict()
+        self.by_api: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, camera_id: Optional[int]):
+        if camera_id is None:
+            return None
+        entry = self.entries.get(camera_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            self.invalidate(camera_id)
+            return None
+        self.entries.move_to_end(camera_id)
+        return entry
+
+    def _put(self, camera: models.Cameras):
+        self.invalidate(camera.id)
+        entry = CameraEntry(camera.id, camera.parking_lot_id, camera.api, camera.config,
+                            camera_config(camera.config), time.monotonic())
+        self.entries[camera.id] = entry
+        if camera.api is not None:
+            self.by_api[camera.api] = camera.id
+        while len(self.entries) > self.max_size:
+            _, old = self.entries.popitem(last=False)
+            self.by_api.pop(old.api, None)
+            self.evictions += 1
+        return entry
+
+    async def get_by_id(self, camera_id: int, db):
+        entry = self._get(camera_id)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        camera = await db.scalar(select(models.Cameras).where(models.Cameras.id == camera_id))
+        if camera is None:
+            return None
+        return self._put(camera)
+
+    async def get_by_token(self, api: str, db):
+        entry = self._get(self.by_api.get(api))
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        camera = await db.scalar(select(models.Cameras).where(models.Cameras.api == api))
+        if camera is None:
+            return None
+        return self._put(camera)
+
+    def invalidate(self, camera_id: int):
+        entry = self.entries.pop(camera_id, None)
+        if entry is not None and self.by_api.get(entry.api) == camera_id:
+            del self.by_api[entry.api]
+
+    def invalidate_token(self, api: str):
+        camera_id = self.by_api.get(api)
+        if camera_id is not None:
+            self.invalidate(camera_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_api.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+camera_cache = CameraCache()
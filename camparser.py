@@ -1,65 +1,270 @@
 from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import InvalidSessionIdException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import io
 import os
+import random
 import time
 
+CAPTURE_BROWSERS = int(os.getenv("CAPTURE_BROWSERS", "2"))
+CAPTURE_TABS_PER_BROWSER = int(os.getenv("CAPTURE_TABS_PER_BROWSER", "8"))
+CAPTURE_LOAD_TIMEOUT = float(os.getenv("CAPTURE_LOAD_TIMEOUT", "20"))
+CAPTURE_INTERVAL = float(os.getenv("CAPTURE_INTERVAL", "10"))
+CAPTURE_JPEG_QUALITY = float(os.getenv("CAPTURE_JPEG_QUALITY", "0.85"))
 
-def save_camera_frame(camera_id: str, url: str):
-    # Настройка браузера
+# Снимаем кадр прямо с <video> через canvas — это дешевле скриншота.
+# Если видео с другого домена, canvas "загрязнён" и вернётся null — тогда делаем скриншот элемента
+GRAB_FRAME_JS = """
+    const video = arguments[0];
+    try {
+        const canvas = document.createElement('canvas');
+        canvas.width = video.videoWidth;
+        canvas.height = video.videoHeight;
+        canvas.getContext('2d').drawImage(video, 0, 0);
+        return canvas.toDataURL('image/jpeg', arguments[1]);
+    } catch (e) {
+        return null;
+    }
+"""
+
+PLAY_JS = """
+    const video = arguments[0];
+    video.muted = true;  // Отключаем звук для автовоспроизведения
+    video.play().catch(() => {
+        video.setAttribute('controls', '');
+        video.play();
+    });
+"""
+
+
+def png_to_jpeg(data: bytes, quality: float = CAPTURE_JPEG_QUALITY) -> bytes:
+    # Скриншот элемента всегда PNG, а кадры камер хранятся и отдаются как JPEG.
+    # Pillow нужен только здесь: без него приложение должно стартовать
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.open(io.BytesIO(data)).convert("RGB").save(out, "JPEG", quality=round(quality * 100))
+    return out.getvalue()
+
+
+def make_driver():
+    # Настройка браузера. Драйвер находит Selenium Manager, отдельный webdriver_manager не нужен
     options = webdriver.ChromeOptions()
-    options.add_argument("--headless")
+    options.add_argument("--headless=new")
     options.add_argument("--disable-gpu")
     options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--mute-audio")
     options.add_argument("--autoplay-policy=no-user-gesture-required")
+    return webdriver.Chrome(options=options)
+
 
-    driver = webdriver.Chrome(
-        service=Service(ChromeDriverManager().install()),
-        options=options
-    )
+class BrowserSession:
+    """
+    One long-lived headless Chrome with one open tab per camera stream.
+    Selenium drivers are not thread-safe, so every call for this browser
+    runs on its own single worker thread.
+    """
 
-    try:
-        driver.get(url)
+    def __init__(self, index: int, driver_factory=make_driver):
+        self.index = index
+        self.driver_factory = driver_factory
+        self.driver = None
+        self.tabs: dict[int, str] = {}
+        self.urls: dict[int, str] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"browser-{index}")
 
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _ensure_driver(self):
+        if self.driver is None:
+            self.driver = self.driver_factory()
+            self.tabs.clear()
+
+    def _video(self):
         # Ожидаем появление видео элемента
-        video_element = WebDriverWait(driver, 20).until(
+        return WebDriverWait(self.driver, CAPTURE_LOAD_TIMEOUT).until(
             EC.presence_of_element_located((By.TAG_NAME, "video"))
         )
 
-        # Пытаемся запустить видео через JavaScript
-        driver.execute_script("""
-            const video = arguments[0];
-            video.muted = true;  // Отключаем звук для автовоспроизведения
-            video.play().catch(() => {
-                video.setAttribute('controls', '');
-                video.play();
-            });
-        """, video_element)
-
+    def _open_tab(self, camera_id: int, url: str):
+        self._ensure_driver()
+        if camera_id in self.tabs and self.urls.get(camera_id) == url:
+            return
+        if camera_id in self.tabs:
+            self._close_tab(camera_id)
+        if self.tabs or self.driver.current_url not in ("about:blank", "data:,"):
+            self.driver.switch_to.new_window("tab")
+        self.tabs[camera_id] = self.driver.current_window_handle
+        self.urls[camera_id] = url
+        self.driver.get(url)
+        video = self._video()
+        self.driver.execute_script(PLAY_JS, video)
         # Ждем когда видео начнет воспроизводиться (currentTime > 0)
-        WebDriverWait(driver, 20).until(
-            lambda d: d.execute_script("return arguments[0].currentTime > 0", video_element)
+        WebDriverWait(self.driver, CAPTURE_LOAD_TIMEOUT).until(
+            lambda d: d.execute_script("return arguments[0].currentTime > 0", video)
         )
 
-        # Дополнительная задержка для стабилизации изображения
-        time.sleep(1)
+    def _grab(self, camera_id: int) -> bytes:
+        self.driver.switch_to.window(self.tabs[camera_id])
+        video = self._video()
+        data_url = self.driver.execute_script(GRAB_FRAME_JS, video, CAPTURE_JPEG_QUALITY)
+        if data_url and data_url.startswith("data:image/jpeg;base64,"):
+            return base64.b64decode(data_url.split(",", 1)[1])
+        return png_to_jpeg(video.screenshot_as_png)
+
+    def _alive(self) -> bool:
+        if self.driver is None:
+            return False
+        try:
+            self.driver.window_handles
+            return True
+        except WebDriverException:
+            return False
+
+    def _capture(self, camera_id: int, url: str) -> bytes:
+        try:
+            self._open_tab(camera_id, url)
+            return self._grab(camera_id)
+        except WebDriverException as e:
+            # Медленная или сломанная страница — переоткрываем только её вкладку;
+            # браузер перезапускаем, лишь когда умерла вся сессия (с ней уходят вкладки всех камер)
+            if isinstance(e, InvalidSessionIdException) or not self._alive():
+                self._quit()
+            else:
+                self._close_tab(camera_id)
+            self._open_tab(camera_id, url)
+            return self._grab(camera_id)
+
+    def _close_tab(self, camera_id: int):
+        handle = self.tabs.pop(camera_id, None)
+        self.urls.pop(camera_id, None)
+        if handle is None or self.driver is None:
+            return
+        try:
+            if len(self.driver.window_handles) > 1:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+            else:
+                self.driver.get("about:blank")
+        except WebDriverException:
+            pass
+        try:
+            # Новые вкладки открываются из текущего окна, оно должно быть живым
+            self.driver.switch_to.window(self.driver.window_handles[0])
+        except (WebDriverException, IndexError):
+            pass
+
+    def _quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                pass
+        self.driver = None
+        self.tabs.clear()
+        self.urls.clear()
+
+    async def capture(self, camera_id: int, url: str) -> bytes:
+        return await self.run(self._capture, camera_id, url)
+
+    async def close_tab(self, camera_id: int):
+        await self.run(self._close_tab, camera_id)
+
+    async def quit(self):
+        await self.run(self._quit)
+
+
+class CaptureService:
+    """
+    Pool of browser sessions. Every camera gets a tab in the least loaded
+    browser and keeps it, so grabbing a frame is a canvas read instead of a
+    browser start and page load. Watched cameras are grabbed periodically,
+    with jitter so they don't all hit the pool at once.
+    """
+
+    def __init__(self, browsers: int = CAPTURE_BROWSERS, tabs_per_browser: int = CAPTURE_TABS_PER_BROWSER,
+                 driver_factory=make_driver):
+        self.sessions = [BrowserSession(i, driver_factory) for i in range(browsers)]
+        self.tabs_per_browser = tabs_per_browser
+        self.assigned: dict[int, BrowserSession] = {}
+        self.watches: dict[int, asyncio.Task] = {}
+        self.last_capture: dict[int, float] = {}
+        self.captures = 0
+        self.errors = 0
+
+    def _session_for(self, camera_id: int):
+        session = self.assigned.get(camera_id)
+        if session is None:
+            session = min(self.sessions, key=lambda s: sum(1 for v in self.assigned.values() if v is s))
+            if sum(1 for v in self.assigned.values() if v is session) >= self.tabs_per_browser:
+                raise RuntimeError("Capture pool is full")
+            self.assigned[camera_id] = session
+        return session
+
+    async def capture(self, camera_id: int, url: str) -> bytes:
+        session = self._session_for(camera_id)
+        try:
+            data = await session.capture(camera_id, url)
+        except Exception:
+            self.errors += 1
+            raise
+        self.captures += 1
+        self.last_capture[camera_id] = time.time()
+        return data
+
+    async def release(self, camera_id: int):
+        self.unwatch(camera_id)
+        self.last_capture.pop(camera_id, None)
+        session = self.assigned.pop(camera_id, None)
+        if session is not None:
+            await session.close_tab(camera_id)
+
+    def watch(self, camera_id: int, url: str, interval: float, on_frame):
+        self.unwatch(camera_id)
+        self.watches[camera_id] = asyncio.create_task(self._watch(camera_id, url, interval, on_frame))
+
+    def unwatch(self, camera_id: int):
+        task = self.watches.pop(camera_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _watch(self, camera_id: int, url: str, interval: float, on_frame):
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            started = time.monotonic()
+            try:
+                await on_frame(camera_id, await self.capture(camera_id, url))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ошибка для камеры {camera_id}: {str(e)}")
+            await asyncio.sleep(max(interval - (time.monotonic() - started), 0) * random.uniform(0.9, 1.1))
 
-        # Создаем папку для снимков
-        os.makedirs("camera_snapshots", exist_ok=True)
-        screenshot_path = os.path.join("camera_snapshots", f"{camera_id}.png")
+    async def stop(self):
+        for camera_id in list(self.watches):
+            self.unwatch(camera_id)
+        for session in self.sessions:
+            await session.quit()
+        self.assigned.clear()
 
-        # Делаем скриншот элемента
-        video_element.screenshot(screenshot_path)
-        print(f"Снимок сохранен: {screenshot_path}")
-        return True
+    def stats(self):
+        now = time.time()
+        return {
+            "browsers": len(self.sessions),
+            "browsers_running": sum(1 for s in self.sessions if s.driver is not None),
+            "tabs": len(self.assigned),
+            "watched": len(self.watches),
+            "captures": self.captures,
+            "errors": self.errors,
+            "staleness": {camera_id: now - ts for camera_id, ts in self.last_capture.items()},
+        }
 
-    except Exception as e:
-        print(f"Ошибка для камеры {camera_id}: {str(e)}")
-        return False
 
-    finally:
-        driver.quit()
-        
\ No newline at end of file
+capture_service = CaptureService()
@@ -0,0 +1,278 @@
+import asyncio
+import inspect
+import json
+import os
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+
+from sqlalchemy.engine import make_url
+
+from db_main import DATABASE_URL, engine, make_async_url
+
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0").lower() in ("1", "true", "yes")
+CLUSTER_BUS = os.getenv("CLUSTER_BUS", "postgres" if CLUSTER_MODE and engine.dialect.name == "postgresql" else "local")
+CLUSTER_CHANNEL = os.getenv("CLUSTER_CHANNEL", "park_cluster")
+CLUSTER_RETRY = float(os.getenv("CLUSTER_RETRY", "2"))
+CLUSTER_LEADER_KEY = int(os.getenv("CLUSTER_LEADER_KEY", "727001"))
+
+# NOTIFY принимает до 8000 байт
+NOTIFY_MAX_PAYLOAD = 7900
+
+
+class ClusterBus(ABC):
+    """
+    Delivers cache invalidations and ingestion events to the other workers.
+    `publish(kind, *args)` goes to every worker except this one — the caller
+    has already applied the change locally — and there runs the handlers
+    registered with `on(kind, handler)`. Args must be JSON-serializable.
+    When events may have been missed, "resync" handlers run instead.
+
+    One worker at a time is the leader; `lead(start, stop)` runs singleton
+    jobs (like the capture scheduler) only there.
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.handlers: dict[str, list] = {}
+        self.roles = []
+        self.leader = False
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.resyncs = 0
+
+    def on(self, kind: str, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def lead(self, start, stop=None):
+        self.roles.append((start, stop))
+        if self.leader:
+            start()
+
+    def _set_leader(self, leader: bool):
+        if leader == self.leader:
+            return
+        self.leader = leader
+        for start, stop in self.roles:
+            if leader:
+                start()
+            elif stop is not None:
+                result = stop()
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(result)
+
+    def deliver(self, kind: str, args):
+        if kind == "resync":
+            self.resyncs += 1
+        else:
+            self.received += 1
+        for handler in self.handlers.get(kind, ()):
+            try:
+                handler(*args)
+            except Exception as e:
+                self.errors += 1
+                print(f"Ошибка обработки события {kind}: {e}")
+
+    def resync(self):
+        self.deliver("resync", ())
+
+    @abstractmethod
+    def publish(self, kind: str, *args):
+        ...
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        # Свои роли останавливает само приложение при выключении
+        self.leader = False
+
+    def stats(self):
+        return {
+            "bus": type(self).__name__,
+            "worker_id": self.worker_id,
+            "leader": self.leader,
+            "sent": self.sent,
+            "received": self.received,
+            "resyncs": self.resyncs,
+            "errors": self.errors,
+        }
+
+
+class LocalBus(ClusterBus):
+    """
+    In-process stand-in. Buses sharing a `hub` list deliver to each other
+    the way separate workers would (handy in tests); a bus on its own is a
+    single worker that is always the leader.
+    """
+
+    def __init__(self, hub: list = None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+
+    def publish(self, kind: str, *args):
+        self.sent += 1
+        # Через JSON, как по сети: обработчики получают те же типы, что и от Postgres
+        args = json.loads(json.dumps(args))
+        for bus in self.hub:
+            if bus is not self:
+                bus.deliver(kind, args)
+
+    async def start(self):
+        if not any(bus.leader for bus in self.hub):
+            self._set_leader(True)
+
+
+def asyncpg_dsn(url: str) -> str:
+    return make_url(make_async_url(url)).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class PostgresBus(ClusterBus):
+    """
+    LISTEN/NOTIFY on a dedicated asyncpg connection. Outgoing events are
+    queued and packed into as few NOTIFYs as fit the payload limit. After a
+    reconnect this worker resyncs, since it wasn't listening for a while.
+    Leadership is a session-level advisory lock on the same connection, so
+    it moves to another worker when this one dies or loses the connection.
+    """
+
+    def __init__(self, url: str = DATABASE_URL, channel: str = CLUSTER_CHANNEL, retry: float = CLUSTER_RETRY):
+        super().__init__()
+        self.dsn = asyncpg_dsn(url)
+        self.channel = channel
+        self.retry = retry
+        self.outbox: deque[str] = deque()
+        self.connected = False
+        self.reconnects = 0
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+
+    def publish(self, kind: str, *args):
+        message = json.dumps([kind, args], separators=(",", ":"), default=str)
+        if len(message) > NOTIFY_MAX_PAYLOAD - 64:
+            # Слишком крупное событие (массовое удаление) — пусть остальные просто сбросят кэши
+            message = '["resync",[]]'
+        self.outbox.append(message)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            self.errors += 1
+            return
+        if message.get("o") == self.worker_id:
+            return
+        for kind, args in message.get("m", ()):
+            self.deliver(kind, args)
+
+    async def _send(self, conn):
+        while self.outbox:
+            batch = [self.outbox.popleft()]
+            size = len(batch[0])
+            while self.outbox and size + len(self.outbox[0]) + 1 < NOTIFY_MAX_PAYLOAD - 64:
+                batch.append(self.outbox.popleft())
+                size += len(batch[-1]) + 1
+            payload = '{"o":"%s","m":[%s]}' % (self.worker_id, ",".join(batch))
+            try:
+                await conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+            except BaseException:
+                # Не отправилось — вернём в начало очереди и повторим после переподключения
+                self.outbox.extendleft(reversed(batch))
+                raise
+            self.sent += len(batch)
+
+    async def _session(self, conn, closed: asyncio.Event):
+        while not self._stopping and not closed.is_set():
+            self._wakeup.clear()
+            if not self.leader and await conn.fetchval("SELECT pg_try_advisory_lock($1)", CLUSTER_LEADER_KEY):
+                self._set_leader(True)
+            await self._send(conn)
+            # Просыпаемся по новым событиям, по обрыву связи или раз в retry — попытаться стать лидером
+            waiters = [asyncio.ensure_future(self._wakeup.wait()), asyncio.ensure_future(closed.wait())]
+            try:
+                await asyncio.wait(waiters, timeout=self.retry, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+        if not closed.is_set():
+            await self._send(conn)
+
+    async def _run(self):
+        import asyncpg
+
+        connected_before = False
+        while not self._stopping:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                self.errors += 1
+                print(f"Шина кластера: нет соединения с БД: {e}")
+                await asyncio.sleep(self.retry)
+                continue
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda connection: closed.set())
+            try:
+                await conn.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                if connected_before:
+                    # Пока не слушали, события могли пройти мимо
+                    self.reconnects += 1
+                    self.resync()
+                connected_before = True
+                await self._session(conn, closed)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                self.errors += 1
+                print(f"Шина кластера: соединение потеряно: {e}")
+            finally:
+                self.connected = False
+                # Блокировка лидера держалась соединением и ушла вместе с ним
+                if self._stopping:
+                    self.leader = False
+                else:
+                    self._set_leader(False)
+                await asyncio.gather(conn.close(timeout=5), return_exceptions=True)
+            if not self._stopping:
+                await asyncio.sleep(self.retry)
+
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout=10)
+            except asyncio.TimeoutError:
+                pass
+            self._task = None
+        self.leader = False
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "outbox": len(self.outbox),
+        }
+
+
+def make_cluster_bus(kind: str = CLUSTER_BUS) -> ClusterBus:
+    if kind == "postgres":
+        return PostgresBus()
+    if kind == "local":
+        if CLUSTER_MODE:
+            print("CLUSTER_MODE без Postgres: кэши других воркеров не будут сбрасываться")
+        return LocalBus()
+    raise ValueError(f"Unknown CLUSTER_BUS: {kind}")
+
+
+cluster_bus = make_cluster_bus()
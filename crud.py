@@ -1,80 +1,253 @@
-from sqlalchemy.orm import Session
+import os
+import time
+from sqlalchemy import select, update, delete, insert, text
 import models
+from db_main import SessionLocal, engine, upsert_insert
+from camera_cache import camera_cache
+from occupancy import occupancy_snapshot
+from aggregate import lot_aggregator
+from ingest import occupancy_queue
+from tokens import token_cache
+from sequences import frame_sequencer
+from cluster import cluster_bus
 
-def read_parking_lot(parking_lot_id: int, db):
-    result = db.query(models.ParkingLots).filter(models.ParkingLots.id == parking_lot_id).first()
-    return result
+LIST_CHUNK = int(os.getenv("LIST_CHUNK", "1000"))
 
-def read_all_parking_lots(db):
-    result = db.query(models.ParkingLots).all()
-    return result
 
-def create_parking_lot(name: str, latitude: float, longitude: float, location_name: str, free_spots: int, capacity: int, db):
-    db_parking_lot = models.ParkingLots(name=name, latitude=latitude, longitude=longitude, location_name=location_name, free_spots=free_spots, capacity=capacity)
+# Колонки, которые списки не отдают ни по умолчанию, ни через fields
+HIDDEN_COLUMNS = {models.Users: {"hashed_password"}}
+
+
+def model_columns(model):
+    if model is models.ParkingLots:
+        return models.PARKING_LOT_COLUMNS
+    hidden = HIDDEN_COLUMNS.get(model, set())
+    return {column.name: column for column in model.__table__.columns if column.name not in hidden}
+
+
+def list_columns(model, fields):
+    # id нужен всегда — по нему строится курсор следующей страницы
+    columns = model_columns(model)
+    if not fields:
+        return list(columns.values())
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    return [columns["id"]] + [columns[name] for name in names if name != "id"]
+
+
+def prefix_filter(column, prefix):
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return column.like(escaped + "%", escape="\\")
+
+
+def list_query(model, fields, after, limit, *filters):
+    stmt = select(*list_columns(model, fields)).where(*filters).order_by(model.id)
+    if model is models.ParkingLots:
+        stmt = stmt.select_from(models.PARKING_LOTS_JOIN)
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    if limit is not None:
+        # Лишняя строка показывает, есть ли следующая страница
+        stmt = stmt.limit(limit + 1)
+    return stmt
+
+
+async def iter_rows(stmt):
+    # Своя сессия: ответ стримится уже после того, как зависимости запроса закрыты
+    async with SessionLocal() as db:
+        result = await db.stream(stmt.execution_options(yield_per=LIST_CHUNK))
+        async for row in result.mappings():
+            yield dict(row)
+
+
+async def read_parking_lot(parking_lot_id: int, db):
+    row = (await db.execute(models.select_parking_lots().where(models.ParkingLots.id == parking_lot_id))).mappings().first()
+    return dict(row) if row is not None else None
+
+def read_all_parking_lots(fields: str = None, after: int = None, limit: int = None, min_free: int = None, name: str = None):
+    filters = []
+    if min_free is not None:
+        filters.append(models.LotOccupancy.free_spots >= min_free)
+    if name:
+        filters.append(prefix_filter(models.ParkingLots.name, name))
+    return iter_rows(list_query(models.ParkingLots, fields, after, limit, *filters))
+
+async def create_parking_lot(name: str, latitude: float, longitude: float, location_name: str, free_spots: int, capacity: int, db):
+    db_parking_lot = models.ParkingLots(name=name, latitude=latitude, longitude=longitude, location_name=location_name, capacity=capacity)
     db.add(db_parking_lot)
-    db.commit()
-    db.refresh(db_parking_lot)
+    await db.flush()
+    db.add(models.LotOccupancy(parking_lot_id=db_parking_lot.id, free_spots=free_spots, updated_at=time.time()))
+    await db.commit()
+    await db.refresh(db_parking_lot)
+    forget_parking_lots([])
 
-def update_parking_lot(parking_lot_id: int, name: str, latitude: float, longitude: float, location_name: str, free_spots: int, capacity: int, db):
-    result = db.query(models.ParkingLots).filter(models.ParkingLots.id == parking_lot_id).update({"name": name, "latitude": latitude, "longitude": longitude, "location_name": location_name, "free_spots": free_spots, "capacity": capacity})
+async def update_parking_lot(parking_lot_id: int, name: str, latitude: float, longitude: float, location_name: str, free_spots: int, capacity: int, db):
+    result = (await db.execute(update(models.ParkingLots).where(models.ParkingLots.id == parking_lot_id).values({"name": name, "latitude": latitude, "longitude": longitude, "location_name": location_name, "capacity": capacity}))).rowcount
     if not result:
         return None
-    db.commit()
+    await upsert_occupancy([{"parking_lot_id": parking_lot_id, "free_spots": free_spots}], db)
+    await db.commit()
+    forget_parking_lots([parking_lot_id])
     return result
 
-def delete_parking_lot(parking_lot_id: int, db):
-    if not db.query(models.ParkingLots).where(models.ParkingLots.id == parking_lot_id).first():
+async def delete_parking_lot(parking_lot_id: int, db):
+    if not await db.scalar(select(models.ParkingLots.id).where(models.ParkingLots.id == parking_lot_id)):
         return None
-    result = db.query(models.ParkingLots).where(models.ParkingLots.id == parking_lot_id).delete()
-    db.commit()
+    # В SQLite внешние ключи не проверяются, так что каскад делаем сами
+    await db.execute(delete(models.LotOccupancy).where(models.LotOccupancy.parking_lot_id == parking_lot_id))
+    result = (await db.execute(delete(models.ParkingLots).where(models.ParkingLots.id == parking_lot_id))).rowcount
+    await db.commit()
+    forget_parking_lots([parking_lot_id])
     return result
 
-def read_cameras(camera_id: int, db):
-    result = db.query(models.Cameras).filter(models.Cameras.id == camera_id).first()
+async def read_cameras(camera_id: int, db):
+    result = await db.scalar(select(models.Cameras).where(models.Cameras.id == camera_id))
     return result
 
-def read_all_cameras(db):
-    result = db.query(models.Cameras).all()
-    return result
+def read_all_cameras(fields: str = None, after: int = None, limit: int = None, parking_lot_id: int = None, name: str = None):
+    filters = []
+    if parking_lot_id is not None:
+        filters.append(models.Cameras.parking_lot_id == parking_lot_id)
+    if name:
+        filters.append(prefix_filter(models.Cameras.name, name))
+    return iter_rows(list_query(models.Cameras, fields, after, limit, *filters))
 
-def create_camera(name: str, parking_lot_id: int, api: str, config, db):
+async def create_camera(name: str, parking_lot_id: int, api: str, config, db):
     db_camera = models.Cameras(name=name, parking_lot_id=parking_lot_id, api=api, config=config)
     db.add(db_camera)
-    db.commit()
-    db.refresh(db_camera)
+    await db.commit()
+    await db.refresh(db_camera)
+    forget_cameras([], [api])
 
-def update_camera(camera_id: int, name: str, parking_lot_id: int, api: str, config, db):
-    result = db.query(models.Cameras).filter(models.Cameras.id == camera_id).update({"name": name, "parking_lot_id": parking_lot_id, "api": api, "config": config})
+async def update_camera(camera_id: int, name: str, parking_lot_id: int, api: str, config, db):
+    result = (await db.execute(update(models.Cameras).where(models.Cameras.id == camera_id).values({"name": name, "parking_lot_id": parking_lot_id, "api": api, "config": config}))).rowcount
     if not result:
         return None
-    db.commit()
+    await db.commit()
+    forget_cameras([camera_id], [api])
     return result
 
-def delete_camera(camera_id: int, db):
-    if not db.query(models.Cameras).where(models.Cameras.id == camera_id).first():
+async def delete_camera(camera_id: int, db):
+    if not await db.scalar(select(models.Cameras.id).where(models.Cameras.id == camera_id)):
         return None
-    result = db.query(models.Cameras).where(models.Cameras.id == camera_id).delete()
-    db.commit()
+    result = (await db.execute(delete(models.Cameras).where(models.Cameras.id == camera_id))).rowcount
+    await db.commit()
+    forget_cameras([camera_id])
     return result
 
-def read_user(user_id: int, db):
-    result = db.query(models.Users).filter(models.Users.id == user_id).first()
+async def read_user(user_id: int, db):
+    result = await db.scalar(select(models.Users).where(models.Users.id == user_id))
     return result
 
-def read_all_users(db):
-    result = db.query(models.Users).all()
-    return result
+def read_all_users(fields: str = None, after: int = None, limit: int = None, username: str = None):
+    filters = []
+    if username:
+        filters.append(prefix_filter(models.Users.username, username))
+    return iter_rows(list_query(models.Users, fields, after, limit, *filters))
 
-def update_user(user_id: int, username: str, password: str, is_superior: bool, db):
-    result = db.query(models.Users).filter(models.Users.id == user_id).update({"username": username, "hashed_password": password, "is_superior": is_superior})
+async def update_user(user_id: int, username: str, password: str, is_superior: bool, db):
+    result = (await db.execute(update(models.Users).where(models.Users.id == user_id).values({"username": username, "hashed_password": password, "is_superior": is_superior, "token_version": models.Users.token_version + 1}))).rowcount
     if not result:
         return None
-    db.commit()
+    await db.commit()
+    forget_users([user_id])
     return result
 
-def delete_user(user_id: int, db):
-    if not db.query(models.Users).where(models.Users.id == user_id).first():
+async def delete_user(user_id: int, db):
+    if not await db.scalar(select(models.Users.id).where(models.Users.id == user_id)):
         return None
-    result = db.query(models.Users).where(models.Users.id == user_id).delete()
-    db.commit()
+    result = (await db.execute(delete(models.Users).where(models.Users.id == user_id))).rowcount
+    await db.commit()
+    forget_users([user_id])
     return result
+
+async def upsert_rows(model, rows: list[dict], db):
+    # Строки без id — один многострочный INSERT ... RETURNING, строки с id — upsert по первичному ключу.
+    # Коммит делает вызывающий, чтобы весь импорт шёл одной транзакцией
+    ids = [row.get("id") for row in rows]
+    new = [i for i, row_id in enumerate(ids) if row_id is None]
+    if new:
+        values = [{k: v for k, v in rows[i].items() if k != "id"} for i in new]
+        result = await db.execute(insert(model).returning(model.id, sort_by_parameter_order=True), values)
+        for i, row_id in zip(new, result.scalars()):
+            ids[i] = row_id
+    existing = [row for row in rows if row.get("id") is not None]
+    if existing:
+        stmt = upsert_insert()(model).values(existing)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[model.id],
+            set_={column.name: stmt.excluded[column.name] for column in model.__table__.columns if column.name != "id"},
+        )
+        await db.execute(stmt)
+        if engine.dialect.name == "postgresql":
+            # Явные id не двигают последовательность, и следующий INSERT без id упёрся бы в дубликат
+            table = model.__tablename__
+            await db.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"
+            ))
+    return ids
+
+async def upsert_occupancy(rows: list[dict], db):
+    now = time.time()
+    stmt = upsert_insert()(models.LotOccupancy).values([{**row, "updated_at": now} for row in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.LotOccupancy.parking_lot_id],
+        set_={"free_spots": stmt.excluded.free_spots, "updated_at": stmt.excluded.updated_at},
+    )
+    await db.execute(stmt)
+
+async def upsert_parking_lots(rows: list[dict], db):
+    # Статические поля — в parking_lots, free_spots — в узкую таблицу занятости
+    ids = await upsert_rows(models.ParkingLots, [{k: v for k, v in row.items() if k != "free_spots"} for row in rows], db)
+    await upsert_occupancy([{"parking_lot_id": row_id, "free_spots": row["free_spots"]} for row_id, row in zip(ids, rows)], db)
+    return ids
+
+async def delete_rows(model, ids: list[int], db):
+    if model is models.ParkingLots:
+        await db.execute(delete(models.LotOccupancy).where(models.LotOccupancy.parking_lot_id.in_(ids)))
+    result = await db.execute(delete(model).where(model.id.in_(ids)).returning(model.id))
+    return list(result.scalars())
+
+def forget_parking_lots_locally(parking_lot_ids):
+    for parking_lot_id in parking_lot_ids:
+        occupancy_queue.discard(parking_lot_id)
+        occupancy_snapshot.invalidate(parking_lot_id)
+    occupancy_snapshot.invalidate()
+
+def forget_cameras_locally(camera_ids, apis=()):
+    for camera_id in camera_ids:
+        camera_cache.invalidate(camera_id)
+        lot_aggregator.forget(camera_id)
+        frame_sequencer.forget(camera_id)
+    for api in apis:
+        camera_cache.invalidate_token(api)
+
+def forget_users_locally(user_ids):
+    for user_id in user_ids:
+        token_cache.revoke_user(user_id)
+
+def forget_everything_locally():
+    # Вызывается, когда события от других воркеров могли потеряться
+    occupancy_snapshot.invalidate()
+    camera_cache.clear()
+    token_cache.clear()
+
+# Изменения, сделанные через этот воркер, сбрасываются и в кэшах остальных
+def forget_parking_lots(parking_lot_ids):
+    forget_parking_lots_locally(parking_lot_ids)
+    cluster_bus.publish("parking_lots", list(parking_lot_ids))
+
+def forget_cameras(camera_ids, apis=()):
+    forget_cameras_locally(camera_ids, apis)
+    cluster_bus.publish("cameras", list(camera_ids), list(apis))
+
+def forget_users(user_ids):
+    forget_users_locally(user_ids)
+    cluster_bus.publish("users", list(user_ids))
+
+cluster_bus.on("parking_lots", forget_parking_lots_locally)
+cluster_bus.on("cameras", forget_cameras_locally)
+cluster_bus.on("users", forget_users_locally)
+cluster_bus.on("resync", forget_everything_locally)
@@ -1,5 +1,4 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from dotenv import load_dotenv
 import os
@@ -7,8 +6,55 @@ import os
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() not in ("0", "false", "no")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def make_async_url(url: str) -> str:
+    # Старые .env содержат синхронный URL (postgresql:// / psycopg2) — подменяем драйвер на asyncpg
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql+psycopg2://"):
+        url = "postgresql+asyncpg://" + url[len("postgresql+psycopg2://"):]
+    elif url.startswith("postgresql://"):
+        url = "postgresql+asyncpg://" + url[len("postgresql://"):]
+    elif url.startswith("sqlite:///"):
+        url = "sqlite+aiosqlite:///" + url[len("sqlite:///"):]
+    return url
+
+
+def make_engine(url: str):
+    url = make_async_url(url)
+    if url.startswith("sqlite"):
+        # SQLite не поддерживает параметры пула QueuePool
+        return create_async_engine(url, pool_pre_ping=DB_POOL_PRE_PING)
+    return create_async_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+engine = make_engine(DATABASE_URL)
+
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+def upsert_insert():
+    # INSERT ... ON CONFLICT есть и в Postgres, и в SQLite, но строится через свой диалект
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+async def begin_for_savepoints(db):
+    # sqlite3 сам открывает транзакцию только перед DML, поэтому SAVEPOINT в начале
+    # сессии становится внешней транзакцией и его RELEASE всё фиксирует — открываем её явно
+    if engine.dialect.name == "sqlite":
+        await (await db.connection()).exec_driver_sql("BEGIN")
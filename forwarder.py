@@ -0,0 +1,105 @@
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+from metrics import Histogram
+
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "64"))
+AI_MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "100"))
+AI_MAX_KEEPALIVE = int(os.getenv("AI_MAX_KEEPALIVE", "20"))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "30"))
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+AI_RETRIES = int(os.getenv("AI_RETRIES", "2"))
+AI_RETRY_BACKOFF = float(os.getenv("AI_RETRY_BACKOFF", "0.2"))
+AI_HTTP2 = os.getenv("AI_HTTP2", "1").lower() not in ("0", "false", "no")
+
+RETRY_STATUSES = {502, 503, 504}
+
+AI_ROUND_TRIP = Histogram("park_ai_round_trip_seconds", "Round trip of one request to the AI server", ("status",))
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class AIForwarder:
+    """
+    One httpx client for the whole application lifetime, so frames reuse
+    pooled keep-alive connections to the AI server instead of a new handshake
+    per request. Limits in-flight forwards and retries transient failures.
+    """
+
+    def __init__(self, max_concurrency: int = AI_MAX_CONCURRENCY, retries: int = AI_RETRIES,
+                 backoff: float = AI_RETRY_BACKOFF):
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.client = None
+        self._semaphore = None
+        self.in_flight = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=AI_HTTP2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=AI_MAX_CONNECTIONS, max_keepalive_connections=AI_MAX_KEEPALIVE),
+                timeout=httpx.Timeout(AI_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def stop(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def post(self, url: str, **kwargs):
+        if self.client is None:
+            self.start()
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                attempt = 0
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        response = await self.client.post(url, **kwargs)
+                        AI_ROUND_TRIP.observe(time.perf_counter() - start, response.status_code)
+                        if response.status_code not in RETRY_STATUSES:
+                            self.sent += 1
+                            return response
+                        if attempt >= self.retries:
+                            # Повторы кончились, а сервер всё ещё недоступен — это отказ, как и обрыв связи
+                            self.failed += 1
+                            return response
+                    except httpx.TransportError:
+                        AI_ROUND_TRIP.observe(time.perf_counter() - start, "error")
+                        if attempt >= self.retries:
+                            self.failed += 1
+                            raise
+                    attempt += 1
+                    self.retried += 1
+                    # Экспоненциальная задержка со случайным разбросом
+                    await asyncio.sleep(self.backoff * (2 ** (attempt - 1)) * (0.5 + random.random()))
+            finally:
+                self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "http2": bool(self.client is not None and AI_HTTP2 and HTTP2_AVAILABLE),
+        }
+
+
+ai_forwarder = AIForwarder()
@@ -0,0 +1,96 @@
+import heapq
+import math
+import os
+
+GEO_CELL_DEGREES = float(os.getenv("GEO_CELL_DEGREES", "0.01"))
+GEO_DEFAULT_LIMIT = int(os.getenv("GEO_DEFAULT_LIMIT", "20"))
+GEO_MAX_LIMIT = int(os.getenv("GEO_MAX_LIMIT", "500"))
+GEO_MAX_RADIUS = float(os.getenv("GEO_MAX_RADIUS", "100000"))
+
+EARTH_RADIUS = 6371000.0
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    # Расстояние по большому кругу в метрах (haversine)
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex:
+    """
+    Uniform lat/lon grid over the lots of the occupancy snapshot. Cells hold
+    the snapshot's own lot dicts, so live free_spots updates are visible
+    without touching the index; it is rebuilt only when the snapshot itself
+    is reloaded after lot CRUD.
+    """
+
+    def __init__(self, cell: float = GEO_CELL_DEGREES):
+        self.cell = cell
+        self.cells: dict[tuple[int, int], list[dict]] = {}
+        self.source = None
+        self.size = 0
+        self.rebuilds = 0
+
+    def _key(self, lat: float, lon: float):
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
+
+    def sync(self, lots: dict):
+        if lots is self.source:
+            return
+        cells = {}
+        size = 0
+        for lot in lots.values():
+            if lot["latitude"] is None or lot["longitude"] is None:
+                continue
+            cells.setdefault(self._key(lot["latitude"], lot["longitude"]), []).append(lot)
+            size += 1
+        self.cells, self.source, self.size = cells, lots, size
+        self.rebuilds += 1
+
+    def _scan(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        min_i, min_j = self._key(min_lat, min_lon)
+        max_i, max_j = self._key(max_lat, max_lon)
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self.cells):
+            # Область больше, чем занятых ячеек — быстрее пройти по ячейкам целиком
+            for (i, j), lots in self.cells.items():
+                if min_i <= i <= max_i and min_j <= j <= max_j:
+                    yield from lots
+            return
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                yield from self.cells.get((i, j), ())
+
+    def nearby(self, lat: float, lon: float, radius: float, min_free: int = 0, limit: int = GEO_DEFAULT_LIMIT):
+        dlat = radius / METERS_PER_DEGREE
+        dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        found = []
+        for lot in self._scan(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+            if (lot["free_spots"] or 0) < min_free:
+                continue
+            d = distance(lat, lon, lot["latitude"], lot["longitude"])
+            if d <= radius:
+                found.append((d, lot["id"], lot))
+        return [{**lot, "distance": d} for d, _, lot in heapq.nsmallest(limit, found)]
+
+    def within(self, bbox, min_free: int = 0, limit: int = GEO_DEFAULT_LIMIT, lat: float = None, lon: float = None):
+        min_lat, min_lon, max_lat, max_lon = bbox
+        found = [
+            lot for lot in self._scan(min_lat, min_lon, max_lat, max_lon)
+            if min_lat <= lot["latitude"] <= max_lat and min_lon <= lot["longitude"] <= max_lon
+            and (lot["free_spots"] or 0) >= min_free
+        ]
+        if lat is None or lon is None:
+            return sorted(found, key=lambda lot: lot["id"])[:limit]
+        # С точкой отсчёта отдаём ближайшие, как и /nearby
+        ranked = ((distance(lat, lon, lot["latitude"], lot["longitude"]), lot["id"], lot) for lot in found)
+        return [{**lot, "distance": d} for d, _, lot in heapq.nsmallest(limit, ranked)]
+
+    def stats(self):
+        return {"lots": self.size, "cells": len(self.cells), "cell_degrees": self.cell, "rebuilds": self.rebuilds}
+
+
+geo_index = GeoIndex()
@@ -0,0 +1,298 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from sqlalchemy import delete, func, insert, select
+
+import models
+from db_main import SessionLocal, engine, upsert_insert
+
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "5"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "1000"))
+HISTORY_MAX_PENDING = int(os.getenv("HISTORY_MAX_PENDING", "100000"))
+HISTORY_MAX_ATTEMPTS = int(os.getenv("HISTORY_MAX_ATTEMPTS", "3"))
+HISTORY_PRUNE_INTERVAL = float(os.getenv("HISTORY_PRUNE_INTERVAL", "3600"))
+HISTORY_RAW_RETENTION = float(os.getenv("HISTORY_RAW_RETENTION", str(7 * 86400)))
+HISTORY_MINUTE_RETENTION = float(os.getenv("HISTORY_MINUTE_RETENTION", str(90 * 86400)))
+HISTORY_HOUR_RETENTION = float(os.getenv("HISTORY_HOUR_RETENTION", str(2 * 365 * 86400)))
+
+RAW = 0
+MINUTE = 60
+HOUR = 3600
+ROLLUP_STEPS = (MINUTE, HOUR)
+UPSERT_CHUNK = 500
+
+
+def rollup_insert():
+    if engine.dialect.name == "postgresql":
+        return upsert_insert(), func.least, func.greatest
+    # В SQLite скалярные min()/max() от нескольких аргументов
+    return upsert_insert(), func.min, func.max
+
+
+def rollup_rows(rows: list[dict]):
+    buckets = {}
+    for row in rows:
+        for step in ROLLUP_STEPS:
+            key = (row["parking_lot_id"], step, int(row["ts"] // step * step))
+            bucket = buckets.get(key)
+            free = row["lot_free"]
+            if bucket is None:
+                buckets[key] = {
+                    "parking_lot_id": key[0], "step": key[1], "bucket": key[2], "samples": 1,
+                    "free_sum": free, "free_min": free, "free_max": free,
+                    "processing_time_sum": row["processing_time"] or 0.0,
+                }
+            else:
+                bucket["samples"] += 1
+                bucket["free_sum"] += free
+                bucket["free_min"] = min(bucket["free_min"], free)
+                bucket["free_max"] = max(bucket["free_max"], free)
+                bucket["processing_time_sum"] += row["processing_time"] or 0.0
+    return list(buckets.values())
+
+
+class HistoryWriter:
+    """
+    Append-only occupancy history. Frames are buffered and written in batches
+    together with 1-minute and 1-hour rollups (upserted, so several batches
+    and several workers can add to the same bucket). Old rows are pruned per
+    tier by retention. A batch that fails `max_attempts` flushes in a row is
+    dropped, and while the DB is unreachable the buffer keeps only the newest
+    `max_pending` rows.
+    """
+
+    def __init__(self, flush_interval: float = HISTORY_FLUSH_INTERVAL, batch_size: int = HISTORY_BATCH_SIZE,
+                 max_pending: int = HISTORY_MAX_PENDING, max_attempts: int = HISTORY_MAX_ATTEMPTS):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.pending: deque[dict] = deque()
+        # Пачка, которую не удалось записать, и сколько раз подряд уже пробовали
+        self.retry: list[dict] = []
+        self.retry_attempts = 0
+        self._lock = None
+        self._wakeup = None
+        self._tasks = []
+        self._stopping = False
+        self.written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.pruned = 0
+
+    def add(self, parking_lot_id: int, camera_id: int, free: int, occupied: int, processing_time: float,
+            lot_free: int):
+        if len(self.pending) >= self.max_pending:
+            # БД недоступна дольше, чем помещается в буфер: жертвуем самыми старыми кадрами
+            self.pending.popleft()
+            self.overflowed += 1
+        self.pending.append({
+            "parking_lot_id": parking_lot_id,
+            "camera_id": camera_id,
+            "free": free,
+            "occupied": occupied,
+            "processing_time": processing_time,
+            "ts": time.time(),
+            "lot_free": lot_free,
+        })
+        if len(self.pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            written = 0
+            if self.retry:
+                batch, attempts, self.retry = self.retry, self.retry_attempts, []
+                if not await self._write(batch, attempts):
+                    return 0
+                written += len(batch)
+            if self.pending:
+                batch = list(self.pending)
+                self.pending.clear()
+                if await self._write(batch, 0):
+                    written += len(batch)
+            return written
+
+    async def _write(self, batch: list[dict], attempts: int):
+        rollups = rollup_rows(batch)
+        dialect_insert, least, greatest = rollup_insert()
+        table = models.OccupancyRollups.__table__
+        try:
+            async with SessionLocal() as db:
+                await db.execute(insert(models.OccupancyHistory), batch)
+                for i in range(0, len(rollups), UPSERT_CHUNK):
+                    stmt = dialect_insert(table).values(rollups[i:i + UPSERT_CHUNK])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[table.c.parking_lot_id, table.c.step, table.c.bucket],
+                        set_={
+                            "samples": table.c.samples + stmt.excluded.samples,
+                            "free_sum": table.c.free_sum + stmt.excluded.free_sum,
+                            "free_min": least(table.c.free_min, stmt.excluded.free_min),
+                            "free_max": greatest(table.c.free_max, stmt.excluded.free_max),
+                            "processing_time_sum": table.c.processing_time_sum + stmt.excluded.processing_time_sum,
+                        },
+                    )
+                    await db.execute(stmt)
+                await db.commit()
+        except Exception as e:
+            self.failed_flushes += 1
+            attempts += 1
+            if attempts >= self.max_attempts:
+                # Пачка, которая раз за разом не пишется, не должна навсегда останавливать историю
+                self.dropped += len(batch)
+                print(f"Ошибка записи истории занятости, отброшено строк: {len(batch)}: {e}")
+            else:
+                self.retry, self.retry_attempts = batch, attempts
+                print(f"Ошибка записи истории занятости: {e}")
+            return False
+        self.written += len(batch)
+        return True
+
+    async def prune(self, now: float = None):
+        now = now or time.time()
+        async with SessionLocal() as db:
+            result = await db.execute(
+                delete(models.OccupancyHistory).where(models.OccupancyHistory.ts < now - HISTORY_RAW_RETENTION)
+            )
+            pruned = result.rowcount or 0
+            for step, retention in ((MINUTE, HISTORY_MINUTE_RETENTION), (HOUR, HISTORY_HOUR_RETENTION)):
+                result = await db.execute(
+                    delete(models.OccupancyRollups)
+                    .where(models.OccupancyRollups.step == step)
+                    .where(models.OccupancyRollups.bucket < now - retention)
+                )
+                pruned += result.rowcount or 0
+            await db.commit()
+        self.pruned += pruned
+        return pruned
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _prune_loop(self):
+        while True:
+            try:
+                await self.prune()
+            except Exception as e:
+                print(f"Ошибка очистки истории занятости: {e}")
+            await asyncio.sleep(HISTORY_PRUNE_INTERVAL)
+
+    def start(self):
+        if not self._tasks:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._prune_loop())]
+
+    async def stop(self):
+        if self._tasks:
+            flush_task, prune_task = self._tasks
+            self._stopping = True
+            self._wakeup.set()
+            await flush_task
+            prune_task.cancel()
+            await asyncio.gather(prune_task, return_exceptions=True)
+            self._tasks = []
+        await self.flush()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.pending) + len(self.retry),
+            "written": self.written,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+            "pruned": self.pruned,
+        }
+
+
+history_writer = HistoryWriter()
+
+
+def pick_tier(start: float, end: float, step):
+    if step is not None:
+        if step >= HOUR:
+            return HOUR
+        if step >= MINUTE:
+            return MINUTE
+        return RAW
+    span = end - start
+    if span <= 3 * HOUR:
+        return RAW
+    if span <= 7 * 86400:
+        return MINUTE
+    return HOUR
+
+
+async def read_history(parking_lot_id: int, start: float, end: float, step, db):
+    """
+    History of one lot between `start` and `end` (epoch seconds), read from
+    the coarsest tier that still fits `step` and regrouped to `step`.
+    """
+    tier = pick_tier(start, end, step)
+    points = {}
+    if tier == RAW:
+        rows = (await db.execute(
+            select(models.OccupancyHistory.ts, models.OccupancyHistory.camera_id, models.OccupancyHistory.free,
+                   models.OccupancyHistory.occupied, models.OccupancyHistory.processing_time,
+                   models.OccupancyHistory.lot_free)
+            .where(models.OccupancyHistory.parking_lot_id == parking_lot_id)
+            .where(models.OccupancyHistory.ts >= start, models.OccupancyHistory.ts < end)
+            .order_by(models.OccupancyHistory.ts)
+        )).all()
+        if step is None:
+            return tier, [
+                {"ts": ts, "camera_id": camera_id, "free": free, "occupied": occupied, "processing_time": pt,
+                 "lot_free": lot_free}
+                for ts, camera_id, free, occupied, pt, lot_free in rows
+            ]
+        # Сводим то же значение стоянки, что и минутные/часовые агрегаты; у старых строк его нет
+        source = (
+            (ts, 1, value, value, value, pt or 0.0)
+            for ts, _, free, _, pt, lot_free in rows
+            for value in [free if lot_free is None else lot_free]
+        )
+    else:
+        table = models.OccupancyRollups
+        rows = (await db.execute(
+            select(table.bucket, table.samples, table.free_sum, table.free_min, table.free_max,
+                   table.processing_time_sum)
+            .where(table.parking_lot_id == parking_lot_id, table.step == tier)
+            .where(table.bucket >= int(start // tier * tier), table.bucket < end)
+            .order_by(table.bucket)
+        )).all()
+        source = rows
+    step = max(int(step or tier), 1)
+    for ts, samples, free_sum, free_min, free_max, pt_sum in source:
+        bucket = int(ts // step * step)
+        point = points.get(bucket)
+        if point is None:
+            points[bucket] = [samples, free_sum, free_min, free_max, pt_sum]
+        else:
+            point[0] += samples
+            point[1] += free_sum
+            point[2] = min(point[2], free_min)
+            point[3] = max(point[3], free_max)
+            point[4] += pt_sum
+    return tier, [
+        {
+            "ts": bucket,
+            "samples": samples,
+            "free_avg": free_sum / samples,
+            "free_min": free_min,
+            "free_max": free_max,
+            "processing_time_avg": pt_sum / samples,
+        }
+        for bucket, (samples, free_sum, free_min, free_max, pt_sum) in points.items()
+    ]
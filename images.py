@@ -0,0 +1,194 @@
+import mimetypes
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from snapshots import Snapshot, SnapshotStore, UPLOAD_CHUNK_SIZE, file_version
+
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+IMAGE_CACHE_MAX_ITEM = int(os.getenv("IMAGE_CACHE_MAX_ITEM", str(2 * 1024 * 1024)))
+IMAGE_MAX_AGE = float(os.getenv("IMAGE_MAX_AGE", "30"))
+IMAGE_DEFAULT_MAX_AGE = float(os.getenv("IMAGE_DEFAULT_MAX_AGE", "1"))
+
+LATEST_RE = re.compile(r"^camera_(\d+)\.[A-Za-z]+$")
+HISTORY_RE = re.compile(r"^camera_(\d+)\.\d+\.[A-Za-z]+$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ImageCache:
+    """
+    Small LRU of hot image bytes keyed by name, bounded by total size.
+    An entry is only used while its version matches the stored snapshot.
+    """
+
+    def __init__(self, max_bytes: int = IMAGE_CACHE_BYTES, max_item: int = IMAGE_CACHE_MAX_ITEM):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.entries: OrderedDict[str, tuple[str, bytes]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str, version: str) -> Optional[bytes]:
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(name)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, name: str, version: str, data: bytes):
+        if len(data) > self.max_item:
+            return
+        self.discard(name)
+        self.entries[name] = (version, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, old) = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+    def discard(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self):
+        return {"size": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+image_cache = ImageCache()
+
+
+def open_image(path, max_bytes: int):
+    # Размер, версия и содержимое берутся от одного открытого файла: кадр могут подменить в любой момент.
+    # Маленький файл читается целиком, большой возвращается открытым и отдаётся потоком
+    source = open(path, "rb")
+    try:
+        stat = os.fstat(source.fileno())
+        if stat.st_size <= max_bytes:
+            with source:
+                return stat, source.read(), None
+        return stat, None, source
+    except BaseException:
+        source.close()
+        raise
+
+
+def file_chunks(source, start: int, length: int):
+    with source:
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def cache_control(name: str, snapshot: Snapshot, store: SnapshotStore):
+    if HISTORY_RE.match(name):
+        # Кадры истории никогда не меняются
+        return "public, max-age=31536000, immutable"
+    match = LATEST_RE.match(name)
+    interval = store.interval(int(match.group(1))) if match else None
+    if interval is None:
+        max_age = IMAGE_DEFAULT_MAX_AGE
+    else:
+        # Кэшируем до ожидаемого прихода следующего кадра
+        max_age = min(max(interval - (time.time() - snapshot.mtime), 0), IMAGE_MAX_AGE)
+    return f"public, max-age={int(max_age)}, must-revalidate"
+
+
+def is_not_modified(request: Request, etag: str, mtime: float):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def byte_range(request: Request, size: int, etag: str, last_modified: str):
+    http_range = request.headers.get("range")
+    if http_range is None:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (etag, last_modified):
+        return None
+    match = RANGE_RE.match(http_range.strip())
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    if start >= size or start > end:
+        return "invalid"
+    return start, end
+
+
+def image_headers(name: str, snapshot: Snapshot, store: SnapshotStore, etag: str):
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(snapshot.mtime, usegmt=True),
+        "Cache-Control": cache_control(name, snapshot, store),
+    }
+
+
+async def image_response(request: Request, name: str, snapshot: Snapshot, store: SnapshotStore):
+    media_type = mimetypes.guess_type(name)[0] or "image/jpeg"
+    data = snapshot.data
+    if data is None:
+        data = image_cache.get(name, snapshot.version)
+    source = None
+    if data is None and snapshot.path is not None and not is_not_modified(request, f'"{snapshot.version}"', snapshot.mtime):
+        stat, data, source = await run_in_threadpool(open_image, snapshot.path, image_cache.max_item)
+        # Если кадр заменили после load(), заголовки строятся по тому, что реально открыли
+        snapshot = replace(snapshot, mtime=stat.st_mtime, size=stat.st_size, version=file_version(stat))
+        if data is not None:
+            image_cache.put(name, snapshot.version, data)
+
+    etag = f'"{snapshot.version}"'
+    headers = image_headers(name, snapshot, store, etag)
+    headers["Accept-Ranges"] = "bytes"
+    last_modified = headers["Last-Modified"]
+    if is_not_modified(request, etag, snapshot.mtime):
+        if source is not None:
+            source.close()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = len(data) if data is not None else snapshot.size
+    requested = byte_range(request, size, etag, last_modified)
+    if requested == "invalid":
+        if source is not None:
+            source.close()
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                        headers={"Content-Range": f"bytes */{size}"})
+    start, end = requested if requested is not None else (0, size - 1)
+    if requested is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    status_code = status.HTTP_206_PARTIAL_CONTENT if requested is not None else status.HTTP_200_OK
+    if source is not None:
+        # Большие файлы не кэшируем, а отдаём кусками из уже открытого файла
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(file_chunks(source, start, end - start + 1), status_code=status_code,
+                                 media_type=media_type, headers=headers)
+    if requested is not None:
+        data = data[start:end + 1]
+    return Response(content=data, status_code=status_code, media_type=media_type, headers=headers)
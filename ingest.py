@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+
+from sqlalchemy import bindparam, update
+
+import models
+from db_main import SessionLocal
+
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+
+occupancy_table = models.LotOccupancy.__table__
+# Core executemany, а не ORM bulk update: строки удалённых стоянок просто не совпадут, без StaleDataError
+update_occupancy = (
+    update(occupancy_table)
+    .where(occupancy_table.c.parking_lot_id == bindparam("b_lot_id"))
+    .values(free_spots=bindparam("b_free"), updated_at=bindparam("b_now"))
+)
+
+
+class OccupancyQueue:
+    """
+    Collects free_spots updates from cameras and writes them in batches.
+    Updates for the same parking lot are merged (last write wins), so the DB
+    sees at most one row update per lot per flush. Updates for lots that no
+    longer exist are skipped; a lot whose update fails `max_attempts` flushes
+    in a row is dropped from the queue.
+    """
+
+    def __init__(self, flush_interval: float = INGEST_FLUSH_INTERVAL, batch_size: int = INGEST_BATCH_SIZE,
+                 session_factory=SessionLocal, max_attempts: int = INGEST_MAX_ATTEMPTS):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.max_attempts = max_attempts
+        self.pending: dict[int, int] = {}
+        self.attempts: dict[int, int] = {}
+        self._wakeup = None
+        self._lock = None
+        self._task = None
+        self._stopping = False
+        self.received = 0
+        self.merged = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def put(self, parking_lot_id: int, free_spots: int):
+        self.received += 1
+        if parking_lot_id in self.pending:
+            self.merged += 1
+        self.pending[parking_lot_id] = free_spots
+        if len(self.pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def discard(self, parking_lot_id: int):
+        # Ручное редактирование/удаление стоянки новее, чем значение в очереди
+        self.pending.pop(parking_lot_id, None)
+        self.attempts.pop(parking_lot_id, None)
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            started = time.perf_counter()
+            try:
+                async with self.session_factory() as db:
+                    # Обновление по первичному ключу узкой таблицы: индексированные колонки не меняются
+                    now = time.time()
+                    result = await db.execute(
+                        update_occupancy,
+                        [{"b_lot_id": lot_id, "b_free": free, "b_now": now} for lot_id, free in batch.items()],
+                    )
+                    await db.commit()
+            except Exception as e:
+                # Возвращаем неудачный батч в очередь, не затирая более свежие значения,
+                # но не дольше max_attempts раз подряд
+                self.failed_flushes += 1
+                retry = {}
+                for lot_id, free in batch.items():
+                    attempts = self.attempts.get(lot_id, 0) + 1
+                    if attempts >= self.max_attempts:
+                        self.attempts.pop(lot_id, None)
+                        self.dropped += 1
+                    else:
+                        self.attempts[lot_id] = attempts
+                        retry[lot_id] = free
+                self.pending = {**retry, **self.pending}
+                print(f"Ошибка записи занятости: {e}")
+                return 0
+            for lot_id in batch:
+                self.attempts.pop(lot_id, None)
+            latency = time.perf_counter() - started
+            self.flushes += 1
+            self.rows_written += result.rowcount if result.rowcount >= 0 else len(batch)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            return len(batch)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            # Примитивы создаём внутри работающего цикла событий
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Не отменяем задачу, чтобы не потерять батч посреди записи
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        # Всё, что осталось в очереди, обязательно пишем перед остановкой
+        await self.flush()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.pending),
+            "received": self.received,
+            "merged": self.merged,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+
+occupancy_queue = OccupancyQueue()
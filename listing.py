@@ -0,0 +1,56 @@
+import json
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "10000"))
+LIST_WRITE_SIZE = 64 * 1024
+
+
+async def json_rows(first, rows, limit, paged):
+    # Пишем JSON кусками по мере чтения курсора, целиком ответ в памяти не держим
+    chunk = bytearray(b'{"items":[' if paged else b"[")
+    count = 0
+    last_id = None
+    more = False
+    try:
+        row = first
+        while row is not None:
+            if limit is not None and count == limit:
+                more = True
+                break
+            if count:
+                chunk += b","
+            chunk += json.dumps(row, separators=(",", ":"), default=str).encode()
+            count += 1
+            last_id = row["id"]
+            if len(chunk) >= LIST_WRITE_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+            row = await anext(rows, None)
+    finally:
+        await rows.aclose()
+    if paged:
+        chunk += b'],"next_cursor":' + json.dumps(last_id if more else None).encode() + b"}"
+    else:
+        chunk += b"]"
+    yield bytes(chunk)
+
+
+async def list_response(read, cursor, limit, not_found: str, **filters):
+    """
+    Streams the rows of a crud.read_all_* query. Without cursor/limit the body
+    is a plain JSON array as before; with them it is
+    {"items": [...], "next_cursor": <id or null>}.
+    """
+    try:
+        rows = read(after=cursor, limit=limit, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    paged = cursor is not None or limit is not None
+    first = await anext(rows, None)
+    if first is None and not paged:
+        await rows.aclose()
+        raise HTTPException(status_code=404, detail=not_found)
+    return StreamingResponse(json_rows(first, rows, limit, paged), media_type="application/json")
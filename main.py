@@ -1,7 +1,12 @@
 from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form
 import json
 
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
+from fastapi import Request, WebSocket, Query
+from starlette.datastructures import Headers
+import asyncio
+import io
+import itertools
 from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel
@@ -10,17 +15,68 @@ from typing import List, Annotated, Optional
 import crud
 import models
 from db_main import engine, SessionLocal
-from sqlalchemy.orm import Session
+from migrations import ensure_schema
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+from ingest import occupancy_queue
+from camera_cache import camera_cache, ConfigField
+from occupancy import occupancy_snapshot
+from stream import occupancy_stream, parse_lots, parse_bbox
+from forwarder import ai_forwarder
+from snapshots import snapshot_store
+from images import image_cache, image_response
+from thumbnails import thumbnail_service, thumbnail_response
 import auth
-from auth import get_current_user, bcrypt_context
+from auth import get_current_user
+from passwords import password_hasher
+from tokens import token_cache
+from metrics import (MetricsMiddleware, Counter, Gauge, Histogram, instrument_engine, loop_lag_monitor, profiler,
+                     registry, METRICS_KEY)
 import httpx, os
 from dotenv import load_dotenv
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 
-#import camparser
-
-app = FastAPI()
+import camparser
+from camparser import capture_service
+from streamgrab import stream_grabber
+from scheduler import capture_scheduler, SCHEDULER_ENABLED
+from aggregate import lot_aggregator, significant
+from history import history_writer, read_history
+from geo import geo_index, GEO_DEFAULT_LIMIT, GEO_MAX_LIMIT, GEO_MAX_RADIUS
+from listing import list_response, LIST_MAX_LIMIT
+from bulk import bulk_upsert_parking_lots, bulk_upsert_cameras, bulk_delete, export_response
+from cluster import cluster_bus
+from sequences import frame_sequencer, next_seq
+import time
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_schema()
+    loop_lag_monitor.start()
+    occupancy_queue.start()
+    history_writer.start()
+    ai_forwarder.start()
+    thumbnail_service.start()
+    if SCHEDULER_ENABLED:
+        # С несколькими воркерами камеры снимает только лидер
+        cluster_bus.lead(lambda: capture_scheduler.start(scheduled_grab, forward_frame), capture_scheduler.stop)
+    await cluster_bus.start()
+    yield
+    await cluster_bus.stop()
+    await capture_scheduler.stop()
+    await ai_forwarder.stop()
+    await capture_service.stop()
+    await stream_grabber.stop()
+    thumbnail_service.shutdown()
+    password_hasher.shutdown()
+    await occupancy_queue.stop()
+    await history_writer.stop()
+    await loop_lag_monitor.stop()
+    await engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Настройка CORS
 origins = [
@@ -35,53 +91,76 @@ app.add_middleware(
     allow_headers=["*"],  # Разрешаем все заголовки
 )
 
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+
 app.include_router(auth.router)
 security = HTTPBearer()
 
 load_dotenv()
 
-crud.models.Base.metadata.create_all(bind=engine)
 OTHER_SERVER_URL = os.getenv("AI_SERVER_URL", "")
 AI_SERVER_KEY = os.getenv("AI_SERVER_KEY", "")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
 
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
 
+INGEST_FRAMES = Counter("park_ingest_frames_total", "Frames received on /receive-image", ("camera",))
+INGEST_STAGE = Histogram("park_ingest_stage_seconds", "Time spent in each /receive-image stage", ("stage",))
+AI_PROCESSING_TIME = Histogram("park_ai_processing_seconds", "processing_time reported by the AI server",
+                               buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0))
+Gauge("park_camera_staleness_seconds", "Seconds since the last frame of each camera", ("camera",),
+      collect=lambda: {(camera_id,): time.time() - ts for camera_id, ts in list(snapshot_store.last_saved.items())})
+Gauge("park_queue_depth", "Pending rows in the write-behind queues", ("queue",),
+      collect=lambda: {("occupancy",): len(occupancy_queue.pending),
+                       ("history",): len(history_writer.pending) + len(history_writer.retry)})
+Gauge("park_queue_dropped_rows", "Rows the write-behind queues gave up on", ("queue", "reason"),
+      collect=lambda: {("occupancy", "attempts"): occupancy_queue.dropped, ("history", "attempts"): history_writer.dropped,
+                       ("history", "overflow"): history_writer.overflowed})
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 @app.get("/images/{image_name}")
-async def get_image(image_name: str):
-    images_dir = Path("uploads")
-    image_path = images_dir / f'{image_name}'
-    
-
+async def get_image(request: Request, image_name: str, w: Optional[int] = None, q: Optional[int] = None):
     # Проверяем существование файла и безопасность пути
-    if not image_path.exists() or not image_path.is_file():
+    snapshot = await snapshot_store.load(image_name)
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
     # Проверяем расширение файла
-    if image_path.suffix.lower() not in [".jpg", ".jpeg", ".png"]:
+    if Path(image_name).suffix.lower() not in [".jpg", ".jpeg", ".png"]:
         raise HTTPException(status_code=400, detail="Invalid image format")
 
-    return FileResponse(image_path)
+    # Уменьшенная копия для превью (?w=320&q=70)
+    if w is not None:
+        return await thumbnail_response(request, image_name, snapshot, snapshot_store, w, q)
+
+    # ETag/Last-Modified, 304 и Range; горячие кадры отдаются из памяти
+    return await image_response(request, image_name, snapshot, snapshot_store)
+
+
+@app.get("/images/history/{camera_id}")
+async def get_image_history(camera_id: int, user: user_dependency):
+    return {"camera_id": camera_id, "images": snapshot_store.history(camera_id)}
 
 
 @app.post("/receive-image")
 async def receive_image(db: db_dependency, free: int = Form(...), occupied: int = Form(...),
                         processing_time: float = Form(...),
-                        camera_id: int = Form(...), token: str = Form(...), image: UploadFile = File(...)):
+                        camera_id: int = Form(...), token: str = Form(...), image: UploadFile = File(...),
+                        seq: Optional[int] = Form(None)):
+    """
+    Result of the AI server for one frame. `seq` is the frame's sequence
+    number (passed to the AI server by /upload); frames older than or equal
+    to the last accepted one of the camera are dropped.
+    """
     if os.getenv("MAIN_SERVER_KEY", "") != token:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tokens didn't match")
 
@@ -89,61 +168,202 @@ async def receive_image(db: db_dependency, free: int = Form(...), occupied: int
         if not image:
             raise HTTPException(400, "No image provided")
 
-        filename = os.path.basename(f'camera_{camera_id}.jpg')
+        started = time.perf_counter()
+        camera = await camera_cache.get_by_id(camera_id, db)
+        if camera is None or camera.parking_lot_id is None:
+            raise HTTPException(404, "Camera is not found")
+        INGEST_STAGE.observe(time.perf_counter() - started, "lookup")
+        if not await frame_sequencer.accept(camera.id, seq, db):
+            # Повтор или кадр, обогнанный более новым — ни файл, ни занятость не трогаем
+            return {"status": "dropped", "seq": seq}
+        INGEST_FRAMES.inc(camera_id)
+        AI_PROCESSING_TIME.observe(processing_time)
 
         # Save the file
-        file_path = UPLOAD_DIR / filename
+        started = time.perf_counter()
+        snapshot = await snapshot_store.save(camera_id, image)
+        thumbnail_service.schedule(snapshot.name, snapshot)
+        INGEST_STAGE.observe(time.perf_counter() - started, "save")
+
+        # Сводим показания всех камер стоянки; пишем и пушим только заметные изменения
+        started = time.perf_counter()
+        rule = camera.options.get("combine")
+        combined = lot_aggregator.update(camera.id, camera.parking_lot_id, free, rule)
+        cluster_bus.publish("reading", camera.id, camera.parking_lot_id, free, rule)
+        history_writer.add(camera.parking_lot_id, camera.id, free, occupied, processing_time, combined)
+        capture_scheduler.observe(camera.id, combined)
+        # Снимок всех стоянок ради одного кадра не грузим: пока он сброшен, дельты ждут фоновой загрузки
+        previous = occupancy_snapshot.last_free(camera.parking_lot_id)
+        if significant(previous, combined):
+            # Обновление занятости уходит в очередь и пишется пачкой
+            occupancy_queue.put(camera.parking_lot_id, combined)
+            push_occupancy(camera.parking_lot_id, combined)
+        INGEST_STAGE.observe(time.perf_counter() - started, "occupancy")
 
-        contents = await image.read()
-        with open(file_path, "wb") as f:
-            f.write(contents)
-
-        cur_parking_lot_id = db.query(crud.models.Cameras).filter(crud.models.Cameras.id == camera_id).first().parking_lot_id
-        cur_parking_lot = db.query(crud.models.ParkingLots).filter(crud.models.ParkingLots.id == cur_parking_lot_id).first()
-        crud.update_parking_lot(cur_parking_lot_id, cur_parking_lot.name, cur_parking_lot.latitude, cur_parking_lot.longitude, cur_parking_lot.location_name, free, cur_parking_lot.capacity, db)
-        
         return {
             "status": "success",
-            "file_name": filename,
-            "file_path": file_path
+            "file_name": snapshot.name,
+            "file_path": snapshot.path
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Error saving file: {str(e)}")
 
 
+def push_occupancy(parking_lot_id: int, free: int):
+    if occupancy_snapshot.update_free(parking_lot_id, free):
+        occupancy_stream.publish(occupancy_snapshot.lots[parking_lot_id])
+    elif occupancy_snapshot.lots is None and occupancy_stream.subscribers:
+        occupancy_snapshot.warm(occupancy_stream.publish)
+
+
+def apply_reading(camera_id: int, parking_lot_id: int, free: int, rule: Optional[str]):
+    # Кадр принял другой воркер: сводим показания и пушим клиентам так же, а в БД пишет он сам
+    combined = lot_aggregator.update(camera_id, parking_lot_id, free, rule)
+    # Планировщик работает на лидере, а результат мог прийти на другой воркер
+    capture_scheduler.observe(camera_id, combined)
+    previous = occupancy_snapshot.last_free(parking_lot_id)
+    if significant(previous, combined):
+        push_occupancy(parking_lot_id, combined)
+
+
+cluster_bus.on("reading", apply_reading)
+
+
+@app.get("/ingest/stats")
+async def ingest_stats(user: user_dependency):
+    return occupancy_queue.stats()
+
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """Prometheus text format. With METRICS_KEY set, scrape with "Authorization: Bearer <key>"."""
+    if METRICS_KEY and request.headers.get("authorization") != f"Bearer {METRICS_KEY}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics key")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profiles/{profile_id}")
+async def read_profile(profile_id: str, user: user_dependency):
+    """Collapsed stacks of a request profiled with "X-Profile: <PROFILE_KEY>"."""
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="profile is not found")
+    return PlainTextResponse(profile.collapsed())
+
+
+@app.get("/cache/stats")
+async def cache_stats(user: user_dependency):
+    return {
+        "cameras": camera_cache.stats(),
+        "parking_lots": occupancy_snapshot.stats(),
+        "stream": occupancy_stream.stats(),
+        "ai_forwarder": ai_forwarder.stats(),
+        "images": image_cache.stats(),
+        "thumbnails": thumbnail_service.stats(),
+        "aggregator": lot_aggregator.stats(),
+        "history": history_writer.stats(),
+        "geo": geo_index.stats(),
+        "passwords": password_hasher.stats(),
+        "tokens": token_cache.stats(),
+        "sequences": frame_sequencer.stats(),
+        "cluster": cluster_bus.stats(),
+    }
+
+
+@app.websocket("/ws/occupancy")
+async def occupancy_websocket(websocket: WebSocket, lots: Optional[str] = None, bbox: Optional[str] = None):
+    """
+    Pushes free_spots deltas. Filter with ?lots=1,2 or ?bbox=min_lat,min_lon,max_lat,max_lon,
+    or later by sending {"lots": [...]} / {"bbox": [...]}.
+    """
+    try:
+        subscriber = occupancy_stream.subscribe(parse_lots(lots), parse_bbox(bbox))
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+
+    async def sender():
+        while True:
+            await websocket.send_json(await subscriber.queue.get())
+
+    async def receiver():
+        while True:
+            # Битое сообщение — ответ с ошибкой, а не разрыв соединения
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                if not isinstance(message, dict):
+                    raise ValueError("message must be an object")
+                if "lots" in message:
+                    subscriber.lots = parse_lots(message["lots"])
+                if "bbox" in message:
+                    subscriber.bbox = parse_bbox(message["bbox"])
+            except (TypeError, ValueError):
+                await websocket.send_json({"error": "invalid subscription"})
+
+    tasks = [asyncio.create_task(sender()), asyncio.create_task(receiver())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Обычно это WebSocketDisconnect — клиент ушёл
+            task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        occupancy_stream.unsubscribe(subscriber)
+
+
+@app.get("/sse/occupancy")
+async def occupancy_sse(request: Request, lots: Optional[str] = None, bbox: Optional[str] = None):
+    try:
+        subscriber = occupancy_stream.subscribe(parse_lots(lots), parse_bbox(bbox))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid lots or bbox")
+    return StreamingResponse(occupancy_stream.sse_events(subscriber, request), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 async def forward_image(payload: dict, file: UploadFile):
     await file.seek(0)
-    async with httpx.AsyncClient() as client:
-        config_json = json.dumps(payload.get("config", {}))
-
-        return await client.post(
-            OTHER_SERVER_URL,
-            data={
-                "token": payload["token"],
-                "camera_id": payload["camera_id"],
-                "config": config_json
-            },
-            files={"image": (file.filename, await file.read(), file.content_type)}
-        )
+    config_json = json.dumps(payload.get("config", {}))
+
+    # Общий клиент с пулом соединений, лимитом параллельности и повторами.
+    # Файл отдаётся httpx как поток и читается кусками, а не целиком в память
+    return await ai_forwarder.post(
+        OTHER_SERVER_URL,
+        data={
+            "token": payload["token"],
+            "camera_id": payload["camera_id"],
+            "config": config_json,
+            "seq": payload["seq"],
+        },
+        files={"image": (file.filename, file.file, file.content_type)}
+    )
 
 
 @app.post("/upload")
 async def upload_image(db: db_dependency, token: str = Form(...), file: UploadFile = File(...)):
     """
     Receives image and optionally a token, forwards to external server.
+    The frame gets a sequence number from this server's clock, which the AI
+    server hands back to /receive-image.
     """
     # Use either client-provided token or server-configured token
-    forward_id = db.query(crud.models.Cameras).filter(crud.models.Cameras.api == token).first()
-    if not forward_id:
+    camera = await camera_cache.get_by_token(token, db)
+    if not camera:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Camera with this token is not found")
-    forward_id = forward_id.id
-    forward_config = db.query(crud.models.Cameras).filter(crud.models.Cameras.api == token).first().config
+    forward_id = camera.id
+    forward_config = camera.config
 
     payload = {
         "token": AI_SERVER_KEY,
         "camera_id": forward_id,
         "config": forward_config,
+        "seq": next_seq(),
     }
 
     try:
@@ -166,25 +386,212 @@ async def user(user: user_dependency, db: db_dependency):
     return {"User": user}
 
 
+async def store_frame(camera_id: int, data: bytes):
+    snapshot = await snapshot_store.save(camera_id, UploadFile(file=io.BytesIO(data), filename=f"camera_{camera_id}.jpg"))
+    thumbnail_service.schedule(snapshot.name, snapshot)
+    return snapshot
+
+
+async def forward_frame(camera_id: int, data: bytes):
+    """
+    Sends a captured frame down the same path as /upload: to the AI server,
+    which reports occupancy back through /receive-image.
+    """
+    if not OTHER_SERVER_URL:
+        return await store_frame(camera_id, data)
+    async with SessionLocal() as db:
+        camera = await camera_cache.get_by_id(camera_id, db)
+    if camera is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="camera is not found")
+    payload = {
+        "token": AI_SERVER_KEY,
+        "camera_id": camera.id,
+        "config": camera.config,
+        "seq": next_seq(),
+    }
+    media_type = "image/jpeg" if data[:2] == b"\xff\xd8" else "image/png"
+    file = UploadFile(file=io.BytesIO(data), filename=f"camera_{camera_id}.jpg", headers=Headers({"content-type": media_type}))
+    response = await forward_image(payload, file)
+    response.raise_for_status()
+    return response
+
+
+def capture_backend(backend: str):
+    # browser — страница с <video> через Selenium, stream — прямой HLS/MJPEG/RTSP через ffmpeg
+    if backend == "browser":
+        return capture_service
+    if backend == "stream":
+        return stream_grabber
+    raise HTTPException(status_code=400, detail="backend must be 'browser' or 'stream'")
+
+
+# Отрицательные ключи разовых снимков не пересекаются с id камер и между параллельными запросами
+oneshot_keys = itertools.count(1)
+
+
 @app.get('/camscreen')
-async def getscreen(url, user: user_dependency):
-    return camparser.capture_video_frames(url)
+async def getscreen(url: str, user: user_dependency, camera_id: Optional[int] = None, backend: str = "browser"):
+    """
+    Grabs one frame from a camera page or stream. With camera_id the frame is
+    stored like any other snapshot and served by /images, otherwise it is
+    returned as is.
+    """
+    grabber = capture_backend(backend)
+    try:
+        if camera_id is not None:
+            snapshot = await store_frame(camera_id, await grabber.capture(camera_id, url))
+            return {"status": "success", "file_name": snapshot.name}
+        # Разовый снимок: временная вкладка, закрываем сразу после кадра
+        key = -next(oneshot_keys)
+        try:
+            data = await grabber.capture(key, url)
+        finally:
+            await grabber.release(key)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Capture failed: {str(e)}")
+    media_type = "image/jpeg" if data[:2] == b"\xff\xd8" else "image/png"
+    return Response(content=data, media_type=media_type)
+
+
+class WatchRequest(BaseModel):
+    camera_id: int
+    url: str
+    interval: float = camparser.CAPTURE_INTERVAL
+    backend: str = "browser"
+    keyframes_only: bool = True
+    forward: bool = True
+
+
+@app.post('/camscreen/watch')
+async def watch_camera(watch: WatchRequest, user: user_dependency):
+    if watch.interval <= 0:
+        raise HTTPException(status_code=400, detail="interval must be positive")
+    grabber = capture_backend(watch.backend)
+    # Камера может смотреться только одним способом
+    for other in (capture_service, stream_grabber):
+        if other is not grabber and watch.camera_id in other.watches:
+            await other.release(watch.camera_id)
+    on_frame = forward_frame if watch.forward else store_frame
+    if grabber is stream_grabber:
+        stream_grabber.watch(watch.camera_id, watch.url, watch.interval, on_frame, watch.keyframes_only)
+    else:
+        capture_service.watch(watch.camera_id, watch.url, watch.interval, on_frame)
+    return {"status": "success", "camera_id": watch.camera_id}
+
+
+@app.delete('/camscreen/watch/{camera_id}')
+async def unwatch_camera(camera_id: int, user: user_dependency):
+    for grabber in (capture_service, stream_grabber):
+        if camera_id in grabber.watches:
+            await grabber.release(camera_id)
+            return {"status": "success", "camera_id": camera_id}
+    raise HTTPException(status_code=404, detail="camera is not watched")
+
+
+async def scheduled_grab(camera_id: int, url: str, backend: str):
+    return await capture_backend(backend).capture(camera_id, url)
+
+
+@app.get('/scheduler/stats')
+async def scheduler_stats(user: user_dependency):
+    return capture_scheduler.stats()
+
+
+@app.get('/camscreen/stats')
+async def capture_stats(user: user_dependency):
+    return {"browser": capture_service.stats(), "stream": stream_grabber.stats()}
+
+
+@app.get("/parking_lots/export")
+async def export_parking_lots(user: user_dependency, format: str = "ndjson"):
+    return export_response(crud.read_all_parking_lots(), format, "parking_lots")
+
+
+@app.post("/parking_lots/bulk")
+async def bulk_parking_lots(request: Request, db: db_dependency, user: user_dependency, atomic: bool = False):
+    """
+    Creates or updates many lots in one transaction. The body is a JSON array,
+    NDJSON (application/x-ndjson) or CSV with a header row (text/csv), so an
+    export can be imported back as is; items with "id" are upserted.
+    """
+    return await bulk_upsert_parking_lots(request, db, atomic)
+
+
+@app.post("/parking_lots/bulk/delete")
+async def bulk_delete_parking_lots(request: Request, db: db_dependency, user: user_dependency):
+    return await bulk_delete(request, models.ParkingLots, crud.forget_parking_lots, db)
+
+
+@app.get("/parking_lots/nearby")
+async def nearby_parking_lots(db: db_dependency, lat: float = Query(..., ge=-90, le=90),
+                              lon: float = Query(..., ge=-180, le=180), radius: float = Query(1000, gt=0, le=GEO_MAX_RADIUS),
+                              min_free: int = 0, limit: int = Query(GEO_DEFAULT_LIMIT, gt=0, le=GEO_MAX_LIMIT)):
+    """Lots within `radius` meters of the point, nearest first, with `distance` in meters."""
+    geo_index.sync(await occupancy_snapshot.load(db))
+    return geo_index.nearby(lat, lon, radius, min_free, limit)
+
+
+@app.get("/parking_lots/bbox")
+async def parking_lots_in_bbox(db: db_dependency, bbox: str, min_free: int = 0,
+                               limit: int = Query(GEO_DEFAULT_LIMIT, gt=0, le=GEO_MAX_LIMIT),
+                               lat: Optional[float] = None, lon: Optional[float] = None):
+    """
+    Lots inside bbox=min_lat,min_lon,max_lat,max_lon. With lat/lon they are
+    sorted by distance from that point, otherwise by id.
+    """
+    try:
+        box = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if box is None:
+        raise HTTPException(status_code=400, detail="bbox must be min_lat,min_lon,max_lat,max_lon")
+    geo_index.sync(await occupancy_snapshot.load(db))
+    return geo_index.within(box, min_free, limit, lat, lon)
+
+
+@app.get("/parking_lots/{parking_lot_id}/history")
+async def read_parking_lot_history(parking_lot_id: int, db: db_dependency, start: Optional[float] = Query(None, alias="from"),
+                                   end: Optional[float] = Query(None, alias="to"), step: Optional[int] = None):
+    """
+    Occupancy history of a lot. `from`/`to` are epoch seconds (last 24 hours
+    by default), `step` is the point spacing in seconds; without it the tier
+    is picked by the length of the range.
+    """
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    if start >= end:
+        raise HTTPException(status_code=400, detail="from must be before to")
+    if step is not None and step <= 0:
+        raise HTTPException(status_code=400, detail="step must be positive")
+    tier, points = await read_history(parking_lot_id, start, end, step, db)
+    return {"parking_lot_id": parking_lot_id, "from": start, "to": end, "tier": tier, "points": points}
 
 
 @app.get("/parking_lots/{parking_lot_id}")
 async def read_parking_lot_endpoint(parking_lot_id: int, db: db_dependency):
-    result = crud.read_parking_lot(parking_lot_id=parking_lot_id, db=db)
+    result = await crud.read_parking_lot(parking_lot_id=parking_lot_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="parking lot is not found")
     return result
 
 
 @app.get("/parking_lots")
-async def read_all_parking_lots_endpoint(db: db_dependency):
-    result = crud.read_all_parking_lots(db)
-    if not result:
+async def read_all_parking_lots_endpoint(request: Request, db: db_dependency, fields: Optional[str] = None,
+                                         cursor: Optional[int] = None,
+                                         limit: Optional[int] = Query(None, gt=0, le=LIST_MAX_LIMIT),
+                                         min_free: Optional[int] = None, name: Optional[str] = None):
+    if any(value is not None for value in (fields, cursor, limit, min_free, name)):
+        # Выборка/страницы идут в SQL, снимок отдаётся только целиком
+        return await list_response(crud.read_all_parking_lots, cursor, limit, "no parking lots found",
+                                   fields=fields, min_free=min_free, name=name)
+    # Отдаём заранее сериализованный снимок вместо SELECT * на каждый запрос
+    body, etag = await occupancy_snapshot.render(db)
+    if body == b"[]":
         raise HTTPException(status_code=404, detail="no parking lots found")
-    return result
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 class CreateParkRequest(BaseModel):
     name: str
@@ -205,13 +612,14 @@ class EditParkRequest(BaseModel):
 
 @app.post("/parking_lots")
 async def create_parking_lot_endpoint(createpark: CreateParkRequest, db: db_dependency, user: user_dependency):
-    crud.create_parking_lot(createpark.name, createpark.latitude, createpark.longitude, createpark.location_name, createpark.free_spots, createpark.capacity, db)
+    await crud.create_parking_lot(createpark.name, createpark.latitude, createpark.longitude, createpark.location_name, createpark.free_spots, createpark.capacity, db)
 
 
 @app.post("/parking_lots/{parking_lot_id}")
 async def update_parking_lot_endpoint(editpark: EditParkRequest, db: db_dependency,
                                       user: user_dependency):
-    result = crud.update_parking_lot(editpark.parking_lot_id, editpark.name, editpark.latitude, editpark.longitude, editpark.location_name, editpark.free_spots, editpark.capacity, db)
+    occupancy_queue.discard(editpark.parking_lot_id)
+    result = await crud.update_parking_lot(editpark.parking_lot_id, editpark.name, editpark.latitude, editpark.longitude, editpark.location_name, editpark.free_spots, editpark.capacity, db)
     if not result:
         raise HTTPException(status_code=404, detail="parking lot is not found")
     return result
@@ -219,51 +627,68 @@ async def update_parking_lot_endpoint(editpark: EditParkRequest, db: db_dependen
 
 @app.delete("/parking_lots/{parking_lot_id}")
 async def delete_parking_lot_endpoint(parking_lot_id: int, db: db_dependency, user: user_dependency):
-    result = crud.delete_parking_lot(parking_lot_id=parking_lot_id, db=db)
+    occupancy_queue.discard(parking_lot_id)
+    result = await crud.delete_parking_lot(parking_lot_id=parking_lot_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="parking lot is not found")
     return result
 
 
+@app.get("/cameras/export")
+async def export_cameras(user: user_dependency, format: str = "ndjson"):
+    return export_response(crud.read_all_cameras(), format, "cameras")
+
+
+@app.post("/cameras/bulk")
+async def bulk_cameras(request: Request, db: db_dependency, user: user_dependency, atomic: bool = False):
+    """Same as /parking_lots/bulk for cameras."""
+    return await bulk_upsert_cameras(request, db, atomic)
+
+
+@app.post("/cameras/bulk/delete")
+async def bulk_delete_cameras(request: Request, db: db_dependency, user: user_dependency):
+    return await bulk_delete(request, models.Cameras, crud.forget_cameras, db)
+
+
 @app.get("/cameras/{camera_id}")
 async def read_camera_endpoint(camera_id: int, db: db_dependency):
-    result = crud.read_cameras(camera_id=camera_id, db=db)
+    result = await crud.read_cameras(camera_id=camera_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="camera is not found")
     return result
 
 
 @app.get("/cameras")
-async def read_all_cameras_endpoint(db: db_dependency):
-    result = crud.read_all_cameras(db)
-    if not result:
-        raise HTTPException(status_code=404, detail="no cameras found")
-    return result
+async def read_all_cameras_endpoint(fields: Optional[str] = None, cursor: Optional[int] = None,
+                                    limit: Optional[int] = Query(None, gt=0, le=LIST_MAX_LIMIT),
+                                    parking_lot_id: Optional[int] = None, name: Optional[str] = None):
+    return await list_response(crud.read_all_cameras, cursor, limit, "no cameras found",
+                               fields=fields, parking_lot_id=parking_lot_id, name=name)
 
 
 class CreateCameraRequest(BaseModel):
     name: str
     parking_lot_id: int
     api: str
-    config: str
+    config: ConfigField
 
 class EditCameraRequest(BaseModel):
     camera_id: int
     name: str
     parking_lot_id: int
     api: str
-    config: str
+    config: ConfigField
 
 @app.post("/cameras")
 async def create_camera_endpoint(createcamera: CreateCameraRequest, db: db_dependency,
                                  user: user_dependency):
-    crud.create_camera(createcamera.name, createcamera.parking_lot_id, createcamera.api, createcamera.config, db)
+    await crud.create_camera(createcamera.name, createcamera.parking_lot_id, createcamera.api, createcamera.config, db)
 
 
 @app.post("/cameras/{camera_id}")
 async def update_camera_endpoint(editcamera: EditCameraRequest, db: db_dependency,
                                  user: user_dependency):
-    result = crud.update_camera(editcamera.camera_id, editcamera.name, editcamera.parking_lot_id, editcamera.api, editcamera.config, db)
+    result = await crud.update_camera(editcamera.camera_id, editcamera.name, editcamera.parking_lot_id, editcamera.api, editcamera.config, db)
     if not result:
         raise HTTPException(status_code=404, detail="camera is not found")
     return result
@@ -271,22 +696,22 @@ async def update_camera_endpoint(editcamera: EditCameraRequest, db: db_dependenc
 
 @app.delete("/cameras/{camera_id}")
 async def delete_camera_endpoint(camera_id: int, db: db_dependency, user: user_dependency):
-    result = crud.delete_camera(camera_id=camera_id, db=db)
+    result = await crud.delete_camera(camera_id=camera_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="camera is not found")
     return result
 
 
 @app.get("/users")
-async def read_all_users_endpoint(db: db_dependency, user: user_dependency):
-    result = crud.read_all_users(db)
-    if not result:
-        raise HTTPException(status_code=404, detail="no users found")
-    return result
+async def read_all_users_endpoint(user: user_dependency, fields: Optional[str] = None, cursor: Optional[int] = None,
+                                 limit: Optional[int] = Query(None, gt=0, le=LIST_MAX_LIMIT),
+                                 username: Optional[str] = None):
+    return await list_response(crud.read_all_users, cursor, limit, "no users found",
+                               fields=fields, username=username)
 
 @app.get("/users/{user_id}")
 async def read_user_endpoint(db: db_dependency, user_id: int, user: user_dependency):
-    result = crud.read_user(user_id=user_id, db=db)
+    result = await crud.read_user(user_id=user_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="user is not found")
     return result
@@ -301,15 +726,15 @@ class EditUserRequest(BaseModel):
 
 @app.post("/users/{user_id}")
 async def update_user_endpoint(editrequest: EditUserRequest, db: db_dependency, user: user_dependency):
-    hashed_password = bcrypt_context.hash(editrequest.password)
-    result = crud.update_user(editrequest.user_id, editrequest.username, hashed_password, editrequest.is_superior, db)
+    hashed_password = await password_hasher.hash(editrequest.password)
+    result = await crud.update_user(editrequest.user_id, editrequest.username, hashed_password, editrequest.is_superior, db)
     if not result:
         raise HTTPException(status_code=404, detail="user is not found")
     return result
 
 @app.delete("/users/{user_id}")
 async def delete_user_endpoint(user_id: int, db: db_dependency, user: user_dependency):
-    result = crud.delete_user(user_id=user_id, db=db)
+    result = await crud.delete_user(user_id=user_id, db=db)
     if not result:
         raise HTTPException(status_code=404, detail="user is not found")
     return result
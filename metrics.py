@@ -0,0 +1,306 @@
+import asyncio
+import bisect
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as StackCounter, deque
+
+METRICS_KEY = os.getenv("METRICS_KEY", "")
+METRICS_LOOP_INTERVAL = float(os.getenv("METRICS_LOOP_INTERVAL", "0.5"))
+PROFILE_KEY = os.getenv("PROFILE_KEY", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        registry.register(self)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += self.samples()
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def remove(self, *labels):
+        self.values.pop(labels, None)
+
+    def samples(self):
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """Either set explicitly or computed at scrape time by `collect` -> {labels tuple: value}."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self.values
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in list(values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам (не накопительные), сумма, количество]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def samples(self):
+        lines = []
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = Histogram("park_http_request_duration_seconds", "HTTP request latency by route",
+                            ("method", "route", "status"))
+DB_QUERY_LATENCY = Histogram("park_db_query_duration_seconds", "DB statement latency", ("statement", "table"))
+LOOP_LAG = Histogram("park_event_loop_lag_seconds", "How late the event loop woke up a sleeping task",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+def route_label(scope):
+    # Шаблон маршрута, а не сам путь — иначе id и имена файлов раздуют число рядов
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request by method, route template and
+    status. With PROFILE_KEY set, a request carrying "X-Profile: <key>" is
+    also sampled by the profiler and answered with an "X-Profile-Id" header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+        profile = None
+        if PROFILE_KEY:
+            for name, value in scope["headers"]:
+                if name == b"x-profile" and value.decode(errors="replace") == PROFILE_KEY:
+                    profile = profiler.start(f'{scope["method"]} {scope["path"]}')
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile is not None:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profile is not None:
+                profiler.stop(profile)
+            REQUEST_LATENCY.observe(time.perf_counter() - start, scope["method"], route_label(scope), status)
+
+
+TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        table = TABLE_RE.search(statement)
+        DB_QUERY_LATENCY.observe(elapsed, verb, table.group(1) if table else "")
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+class LoopLagMonitor:
+    """Sleeps `interval` in a loop and records how much later than asked it woke up."""
+
+    def __init__(self, interval: float = METRICS_LOOP_INTERVAL):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(loop.time() - start - self.interval, 0.0)
+            LOOP_LAG.observe(self.last_lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+loop_lag_monitor = LoopLagMonitor()
+Gauge("park_event_loop_lag_last_seconds", "Event loop lag at the last check",
+      collect=lambda: {(): loop_lag_monitor.last_lag})
+
+
+class Profile:
+    def __init__(self, label: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.started = time.time()
+        self.duration = 0.0
+        self.samples = 0
+        self.stacks = StackCounter()
+
+    def collapsed(self):
+        # Формат collapsed stacks — его понимают flamegraph.pl и speedscope
+        header = f"# {self.label} {self.duration * 1000:.1f}ms {self.samples} samples\n"
+        return header + "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack from a helper thread every
+    `interval` seconds while a profiled request runs. Everything the loop
+    does in that time is sampled, so it is best used on a quiet instance.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, keep: int = PROFILE_KEEP):
+        self.interval = interval
+        self.profiles: deque[Profile] = deque(maxlen=keep)
+        self._active: dict[str, Profile] = {}
+        self._thread = None
+        self._target = None
+        self._lock = threading.Lock()
+
+    def start(self, label: str) -> Profile:
+        profile = Profile(label)
+        with self._lock:
+            self._active[profile.id] = profile
+            self._target = threading.get_ident()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile: Profile):
+        with self._lock:
+            self._active.pop(profile.id, None)
+        profile.duration = time.time() - profile.started
+        self.profiles.append(profile)
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active.values())
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                collapsed = ";".join(reversed(stack))
+                for profile in active:
+                    profile.stacks[collapsed] += 1
+                    profile.samples += 1
+            time.sleep(self.interval)
+
+    def get(self, profile_id: str):
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+
+profiler = SamplingProfiler()
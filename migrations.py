@@ -0,0 +1,253 @@
+"""
+Versioned schema migrations.
+
+    python migrations.py           # bring the DB up to date
+    python migrations.py --check   # exit 1 if it is behind
+
+With DB_AUTO_MIGRATE=1 (the default) the app migrates on startup. When
+several workers or nodes share a DB, run this once per deploy instead and
+start them with DB_AUTO_MIGRATE=0: they then only check the version.
+
+Every schema change is a new migration with its own DDL, written against
+the schema as that version left it; applied migrations are never edited.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+from sqlalchemy import (BigInteger, Boolean, Column, Float, ForeignKey, Index, Integer, JSON, MetaData, String, Table,
+                        bindparam, func, inspect, select, text)
+
+from db_main import engine
+
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1").lower() not in ("0", "false", "no")
+MIGRATION_LOCK_KEY = int(os.getenv("MIGRATION_LOCK_KEY", "727000"))
+LOT_OCCUPANCY_FILLFACTOR = int(os.getenv("LOT_OCCUPANCY_FILLFACTOR", "70"))
+
+# Индексы, которые ставил index=True на каждой колонке стоянки (и дубли первичных ключей)
+OLD_INDEXES = [f"ix_parking_lots_{column}" for column in
+               ("id", "name", "latitude", "longitude", "location_name", "free_spots", "capacity")] + ["ix_cameras_id"]
+
+version_metadata = MetaData()
+schema_versions = Table(
+    "schema_versions", version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", Float, nullable=False),
+)
+
+# Каждая миграция описывает свои таблицы сама, а не берёт их из models.py:
+# её смысл не должен меняться, когда модели правят дальше
+
+
+async def baseline(conn):
+    """Tables as the app created them before migrations (create_tables)."""
+    metadata = MetaData()
+    Table(
+        "parking_lots", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String, index=True),
+        Column("latitude", Float, index=True),
+        Column("longitude", Float, index=True),
+        Column("location_name", String, index=True),
+        Column("free_spots", Integer, index=True),
+        Column("capacity", Integer, index=True),
+    )
+    Table(
+        "users", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("username", String, unique=True),
+        Column("hashed_password", String),
+        Column("is_superior", Boolean),
+    )
+    Table(
+        "cameras", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("name", String),
+        Column("parking_lot_id", Integer, ForeignKey("parking_lots.id")),
+        Column("api", String, unique=True),
+        Column("config", JSON),
+    )
+    # Базы без schema_versions, созданные ещё create_tables, уже содержат эти таблицы
+    await conn.run_sync(metadata.create_all)
+
+
+async def occupancy_history(conn):
+    metadata = MetaData()
+    Table(
+        "occupancy_history", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("parking_lot_id", Integer, nullable=False),
+        Column("camera_id", Integer),
+        Column("free", Integer),
+        Column("occupied", Integer),
+        Column("processing_time", Float),
+        Column("ts", Float, nullable=False),
+        Index("ix_occupancy_history_lot_ts", "parking_lot_id", "ts"),
+        Index("ix_occupancy_history_ts", "ts"),
+    )
+    Table(
+        "occupancy_rollups", metadata,
+        Column("parking_lot_id", Integer, primary_key=True),
+        Column("step", Integer, primary_key=True),
+        Column("bucket", Integer, primary_key=True),
+        Column("samples", Integer, nullable=False),
+        Column("free_sum", Float, nullable=False),
+        Column("free_min", Integer, nullable=False),
+        Column("free_max", Integer, nullable=False),
+        Column("processing_time_sum", Float, nullable=False),
+        Index("ix_occupancy_rollups_step_bucket", "step", "bucket"),
+    )
+    await conn.run_sync(metadata.create_all)
+
+
+async def users_token_version(conn):
+    await conn.exec_driver_sql("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0")
+
+
+async def camera_sequences(conn):
+    metadata = MetaData()
+    Table(
+        "camera_sequences", metadata,
+        Column("camera_id", Integer, primary_key=True),
+        Column("seq", BigInteger, nullable=False),
+    )
+    await conn.run_sync(metadata.create_all)
+
+
+async def occupancy_split(conn):
+    """
+    Moves free_spots out of parking_lots into the narrow lot_occupancy table,
+    drops the per-column indexes of parking_lots (and the duplicate primary
+    key index of cameras) and indexes cameras.parking_lot_id.
+    """
+    metadata = MetaData()
+    Table("parking_lots", metadata, Column("id", Integer, primary_key=True))
+    lot_occupancy = Table(
+        "lot_occupancy", metadata,
+        Column("parking_lot_id", Integer, ForeignKey("parking_lots.id", ondelete="CASCADE"), primary_key=True),
+        Column("free_spots", Integer),
+        Column("updated_at", Float),
+    )
+    await conn.run_sync(metadata.create_all, tables=[lot_occupancy])
+    if engine.dialect.name == "postgresql":
+        # Свободное место на странице нужно, чтобы новая версия строки легла рядом (HOT)
+        await conn.exec_driver_sql(f"ALTER TABLE lot_occupancy SET (fillfactor = {LOT_OCCUPANCY_FILLFACTOR})")
+    await conn.execute(text(
+        "INSERT INTO lot_occupancy (parking_lot_id, free_spots, updated_at) "
+        "SELECT id, free_spots, :now FROM parking_lots"
+    ), {"now": time.time()})
+    # SQLite не удалит колонку, пока на ней есть индекс
+    for name in OLD_INDEXES:
+        await conn.exec_driver_sql(f"DROP INDEX {name}")
+    await conn.exec_driver_sql("ALTER TABLE parking_lots DROP COLUMN free_spots")
+    await conn.exec_driver_sql("CREATE INDEX ix_cameras_parking_lot_id ON cameras (parking_lot_id)")
+
+
+async def history_lot_free(conn):
+    """
+    Raw history rows keep the combined lot value the rollups are built from,
+    and the append-only table gets a 64-bit id.
+    """
+    await conn.exec_driver_sql("ALTER TABLE occupancy_history ADD COLUMN lot_free INTEGER")
+    if engine.dialect.name == "postgresql":
+        await conn.exec_driver_sql("ALTER TABLE occupancy_history ALTER COLUMN id TYPE BIGINT")
+        sequence = (await conn.exec_driver_sql("SELECT pg_get_serial_sequence('occupancy_history', 'id')")).scalar()
+        if sequence:
+            await conn.exec_driver_sql(f"ALTER SEQUENCE {sequence} AS BIGINT")
+
+
+async def camera_config_objects(conn):
+    """
+    cameras.config becomes a JSON object column (JSONB on Postgres): values
+    the API stored as JSON text are parsed, unparsable ones become {}.
+    """
+    metadata = MetaData()
+    cameras = Table("cameras", metadata, Column("id", Integer, primary_key=True), Column("config", JSON))
+    rows = []
+    for camera_id, config in await conn.execute(select(cameras.c.id, cameras.c.config)):
+        if config is None or isinstance(config, dict):
+            continue
+        try:
+            config = json.loads(config) if isinstance(config, str) else None
+        except ValueError:
+            config = None
+        rows.append({"b_id": camera_id, "b_config": config if isinstance(config, dict) else {}})
+    if rows:
+        await conn.execute(
+            cameras.update().where(cameras.c.id == bindparam("b_id")).values(config=bindparam("b_config")), rows
+        )
+    if engine.dialect.name == "postgresql":
+        await conn.exec_driver_sql("ALTER TABLE cameras ALTER COLUMN config TYPE JSONB USING config::jsonb")
+
+
+MIGRATIONS = [
+    (1, "baseline", baseline),
+    (2, "occupancy_history", occupancy_history),
+    (3, "users_token_version", users_token_version),
+    (4, "camera_sequences", camera_sequences),
+    (5, "occupancy_split", occupancy_split),
+    (6, "history_lot_free", history_lot_free),
+    (7, "camera_config_objects", camera_config_objects),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def read_version(conn):
+    if not inspect(conn).has_table(schema_versions.name):
+        return 0
+    return conn.execute(select(func.max(schema_versions.c.version))).scalar() or 0
+
+
+async def schema_version() -> int:
+    async with engine.connect() as conn:
+        return await conn.run_sync(read_version)
+
+
+async def migrate() -> list[str]:
+    """Applies pending migrations in one transaction and returns their names."""
+    applied = []
+    async with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            # Воркеры, стартующие одновременно, ждут друг друга, а не гоняют DDL параллельно
+            await conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({MIGRATION_LOCK_KEY})")
+        await conn.run_sync(version_metadata.create_all)
+        version = await conn.run_sync(read_version)
+        for number, name, step in MIGRATIONS:
+            if number <= version:
+                continue
+            await step(conn)
+            await conn.execute(schema_versions.insert().values(version=number, name=name, applied_at=time.time()))
+            applied.append(name)
+    return applied
+
+
+async def ensure_schema():
+    if DB_AUTO_MIGRATE:
+        await migrate()
+        return
+    version = await schema_version()
+    if version < SCHEMA_VERSION:
+        # Иначе поток соединения aiosqlite не даст процессу завершиться
+        await engine.dispose()
+        raise RuntimeError(f"DB schema is at version {version}, the app needs {SCHEMA_VERSION}: "
+                           f"run `python migrations.py` first")
+
+
+async def main(check: bool = False):
+    try:
+        if check:
+            version = await schema_version()
+            print(f"schema version {version}, latest {SCHEMA_VERSION}")
+            return 0 if version >= SCHEMA_VERSION else 1
+        applied = await migrate()
+        print(f"applied: {', '.join(applied)}" if applied else "schema is up to date")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main("--check" in sys.argv[1:])))
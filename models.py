@@ -1,17 +1,45 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, JSON
+import json
+
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Float, JSON, Index, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
 from db_main import Base
 
 
+class CameraConfig(TypeDecorator):
+    """
+    Camera config as a JSON object (JSONB on Postgres). JSON text, as the
+    API used to send it, is parsed on write, so rows always hold an object.
+    """
+    impl = JSON().with_variant(JSONB(), 'postgresql')
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            value = json.loads(value)
+        if value is not None and not isinstance(value, dict):
+            raise ValueError("camera config must be a JSON object")
+        return value
+
+
 class ParkingLots(Base):
     __tablename__ = 'parking_lots'
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
-    latitude = Column(Float, index=True)
-    longitude = Column(Float, index=True)
-    location_name = Column(String, index=True)
-    free_spots = Column(Integer, index=True)
-    capacity = Column(Integer, index=True)
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    location_name = Column(String)
+    capacity = Column(Integer)
+
+# Часто меняющаяся часть стоянки. Узкая строка без индексов, кроме первичного ключа,
+# чтобы в Postgres UPDATE шёл как HOT (fillfactor выставляет миграция)
+class LotOccupancy(Base):
+    __tablename__ = 'lot_occupancy'
+
+    parking_lot_id = Column(Integer, ForeignKey(ParkingLots.id, ondelete='CASCADE'), primary_key=True)
+    free_spots = Column(Integer)
+    updated_at = Column(Float)
 
 class Users(Base):
     __tablename__ = 'users'
@@ -20,12 +48,71 @@ class Users(Base):
     username = Column(String, unique=True)
     hashed_password = Column(String)
     is_superior = Column(Boolean)
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
 
 class Cameras(Base):
     __tablename__ = 'cameras'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String)
-    parking_lot_id = Column(Integer, ForeignKey(ParkingLots.id))
+    parking_lot_id = Column(Integer, ForeignKey(ParkingLots.id), index=True)
     api = Column(String, unique=True)
-    config = Column(JSON)
+    config = Column(CameraConfig)
+
+class OccupancyHistory(Base):
+    __tablename__ = 'occupancy_history'
+
+    # В SQLite INTEGER PRIMARY KEY и так 64-битный, а BIGINT перестал бы быть автоинкрементом
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    parking_lot_id = Column(Integer, nullable=False)
+    camera_id = Column(Integer)
+    free = Column(Integer)
+    occupied = Column(Integer)
+    processing_time = Column(Float)
+    ts = Column(Float, nullable=False)
+    lot_free = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_occupancy_history_lot_ts', 'parking_lot_id', 'ts'),
+        Index('ix_occupancy_history_ts', 'ts'),
+    )
+
+class OccupancyRollups(Base):
+    __tablename__ = 'occupancy_rollups'
+
+    parking_lot_id = Column(Integer, primary_key=True)
+    step = Column(Integer, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    samples = Column(Integer, nullable=False)
+    free_sum = Column(Float, nullable=False)
+    free_min = Column(Integer, nullable=False)
+    free_max = Column(Integer, nullable=False)
+    processing_time_sum = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_occupancy_rollups_step_bucket', 'step', 'bucket'),
+    )
+
+class CameraSequences(Base):
+    __tablename__ = 'camera_sequences'
+
+    camera_id = Column(Integer, primary_key=True)
+    seq = Column(BigInteger, nullable=False)
+
+# Стоянка, как её видит API: статические поля и занятость, в прежнем порядке колонок
+PARKING_LOT_COLUMNS = {
+    "id": ParkingLots.id,
+    "name": ParkingLots.name,
+    "latitude": ParkingLots.latitude,
+    "longitude": ParkingLots.longitude,
+    "location_name": ParkingLots.location_name,
+    "free_spots": LotOccupancy.free_spots,
+    "capacity": ParkingLots.capacity,
+}
+PARKING_LOTS_JOIN = ParkingLots.__table__.outerjoin(
+    LotOccupancy.__table__, LotOccupancy.parking_lot_id == ParkingLots.id
+)
+
+
+def select_parking_lots(*columns):
+    return select(*(columns or PARKING_LOT_COLUMNS.values())).select_from(PARKING_LOTS_JOIN)
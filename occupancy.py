@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+
+import models
+from db_main import SessionLocal
+
+
+class OccupancySnapshot:
+    """
+    In-memory copy of all parking lots with a pre-serialized JSON body and ETag.
+    Live free_spots values from ingestion are applied on top of the DB state,
+    lot CRUD invalidates the snapshot so it is reloaded on the next read.
+    Changes that arrive while it is unloaded are kept in `pending` and
+    published by `warm()` once a background reload finishes.
+    """
+
+    def __init__(self):
+        self.lots = None
+        self.live: dict[int, int] = {}
+        self.body = None
+        self.etag = None
+        self.pending: set[int] = set()
+        self.reloads = 0
+        self.warms = 0
+        self._epoch = 0
+        self._lock = None
+        self._warming = None
+
+    def update_free(self, parking_lot_id: int, free_spots: int):
+        # Возвращает True, если изменился загруженный снимок; незагруженный не трогаем и не грузим
+        self.live[parking_lot_id] = free_spots
+        if self.lots is None:
+            self.pending.add(parking_lot_id)
+            return False
+        lot = self.lots.get(parking_lot_id)
+        if lot is None or lot["free_spots"] == free_spots:
+            return False
+        lot["free_spots"] = free_spots
+        self.body = None
+        return True
+
+    def invalidate(self, parking_lot_id: int = None):
+        # Ручное изменение стоянки новее, чем последнее значение с камеры
+        if parking_lot_id is not None:
+            self.live.pop(parking_lot_id, None)
+        self._epoch += 1
+        self.lots = None
+        self.body = None
+
+    async def _load(self, db):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.lots is not None:
+                return self.lots
+            epoch = self._epoch
+            rows = (await db.execute(models.select_parking_lots().order_by(models.ParkingLots.id))).mappings()
+            lots = {}
+            for row in rows:
+                lot = dict(row)
+                if lot["id"] in self.live:
+                    lot["free_spots"] = self.live[lot["id"]]
+                lots[lot["id"]] = lot
+            self.reloads += 1
+            # Если пока шла загрузка стоянку изменили, результат не кэшируем
+            if epoch == self._epoch:
+                self.lots = lots
+            return lots
+
+    async def load(self, db):
+        lots = self.lots
+        if lots is None:
+            lots = await self._load(db)
+        return lots
+
+    def warm(self, publish):
+        # Снимок сброшен, а подписчики ждут дельт: грузим его в фоне, не в обработчике кадра
+        if self._warming is None or self._warming.done():
+            self._warming = asyncio.create_task(self._warm(publish))
+
+    async def _warm(self, publish):
+        try:
+            async with SessionLocal() as db:
+                lots = await self.load(db)
+        except Exception as e:
+            print(f"Ошибка загрузки снимка стоянок: {e}")
+            return
+        self.warms += 1
+        # Всё, что пришло, пока снимок был сброшен (и пока он грузился), уходит подписчикам сейчас
+        pending, self.pending = self.pending, set()
+        for parking_lot_id in pending:
+            lot = lots.get(parking_lot_id)
+            if lot is None or parking_lot_id not in self.live:
+                continue
+            if lot["free_spots"] != self.live[parking_lot_id]:
+                lot["free_spots"] = self.live[parking_lot_id]
+                if lots is self.lots:
+                    self.body = None
+            publish(lot)
+
+    def last_free(self, parking_lot_id: int):
+        # Последнее известное значение без загрузки снимка: из снимка или с камер
+        if self.lots is not None:
+            lot = self.lots.get(parking_lot_id)
+            return lot["free_spots"] if lot is not None else None
+        return self.live.get(parking_lot_id)
+
+    async def get(self, parking_lot_id: int, db):
+        return (await self.load(db)).get(parking_lot_id)
+
+    async def render(self, db):
+        lots = self.lots
+        if lots is None:
+            lots = await self._load(db)
+        if self.body is not None and lots is self.lots:
+            return self.body, self.etag
+        body = json.dumps(list(lots.values()), separators=(",", ":")).encode()
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        if lots is self.lots:
+            self.body, self.etag = body, etag
+        return body, etag
+
+    def stats(self):
+        return {
+            "loaded": self.lots is not None,
+            "size": len(self.lots) if self.lots is not None else 0,
+            "reloads": self.reloads,
+            "warms": self.warms,
+            "pending": len(self.pending),
+        }
+
+
+occupancy_snapshot = OccupancySnapshot()
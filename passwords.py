@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+from metrics import Histogram
+
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+PASSWORD_BCRYPT_ROUNDS = int(os.getenv("PASSWORD_BCRYPT_ROUNDS", "12"))
+LOGIN_RATE = float(os.getenv("LOGIN_RATE", "20"))
+LOGIN_BURST = int(os.getenv("LOGIN_BURST", "20"))
+LOGIN_MAX_WAIT = float(os.getenv("LOGIN_MAX_WAIT", "5"))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "32"))
+LOGIN_PER_USER = int(os.getenv("LOGIN_PER_USER", "2"))
+LOGIN_CACHE_TTL = float(os.getenv("LOGIN_CACHE_TTL", "300"))
+LOGIN_CACHE_SIZE = int(os.getenv("LOGIN_CACHE_SIZE", "10000"))
+
+BCRYPT_LATENCY = Histogram("park_bcrypt_seconds", "bcrypt hash/verify time in the pool, including the wait", ("op",))
+
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=PASSWORD_BCRYPT_ROUNDS)
+
+
+class LoginLimiter:
+    """
+    Token bucket for password checks: `rate` per second with bursts of
+    `burst`. Callers over the limit wait their turn (each reserves the next
+    token), and are turned away with 429 if the wait would exceed `max_wait`.
+    """
+
+    def __init__(self, rate: float = LOGIN_RATE, burst: int = LOGIN_BURST, max_wait: float = LOGIN_MAX_WAIT):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        if wait > self.max_wait:
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many login attempts",
+                                headers={"Retry-After": str(int(wait) + 1)})
+        self.tokens -= 1
+        if wait:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hash/verify in a bounded thread pool (bcrypt releases the
+    GIL) so a burst of logins never blocks the event loop. Login checks also
+    go through a rate limiter and a per-username concurrency limit, and
+    successful checks are remembered for a while so repeated logins with the
+    same password skip bcrypt.
+    """
+
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING,
+                 per_user: int = LOGIN_PER_USER, cache_ttl: float = LOGIN_CACHE_TTL, cache_size: int = LOGIN_CACHE_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.per_user = per_user
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.limiter = LoginLimiter()
+        self.in_flight: dict[str, int] = {}
+        self.verified: OrderedDict[bytes, float] = OrderedDict()
+        # Ключ кэша не должен позволять подобрать пароль, поэтому он солится секретом процесса
+        self._secret = secrets.token_bytes(32)
+        self._executor = None
+        self.hashes = 0
+        self.verifies = 0
+        self.cache_hits = 0
+        self.busy_rejected = 0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            # Очередь к пулу уже длиннее, чем он успеет разобрать — отказываем сразу
+            self.busy_rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Password hashing is overloaded",
+                                headers={"Retry-After": "1"})
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        start = time.perf_counter()
+        hashed_password = await self._run(bcrypt_context.hash, password)
+        BCRYPT_LATENCY.observe(time.perf_counter() - start, "hash")
+        self.hashes += 1
+        return hashed_password
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        start = time.perf_counter()
+        ok = await self._run(bcrypt_context.verify, password, hashed_password)
+        BCRYPT_LATENCY.observe(time.perf_counter() - start, "verify")
+        self.verifies += 1
+        return ok
+
+    def _cache_key(self, username: str, password: str, hashed_password: str):
+        # В ключ входит хеш из БД: после смены пароля старая запись просто не совпадёт
+        return hashlib.blake2b(
+            "\0".join((username, password, hashed_password)).encode(), key=self._secret, digest_size=32
+        ).digest()
+
+    def _cached(self, key: bytes):
+        expires = self.verified.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.verified[key]
+            return False
+        self.verified.move_to_end(key)
+        return True
+
+    async def check_login(self, username: str, password: str, hashed_password: str) -> bool:
+        key = self._cache_key(username, password, hashed_password)
+        if self._cached(key):
+            self.cache_hits += 1
+            return True
+        if self.in_flight.get(username, 0) >= self.per_user:
+            self.busy_rejected += 1
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail="Too many concurrent login attempts", headers={"Retry-After": "1"})
+        self.in_flight[username] = self.in_flight.get(username, 0) + 1
+        try:
+            await self.limiter.acquire()
+            ok = await self.verify(password, hashed_password)
+        finally:
+            self.in_flight[username] -= 1
+            if not self.in_flight[username]:
+                del self.in_flight[username]
+        if ok:
+            self.verified[key] = time.monotonic() + self.cache_ttl
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return ok
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "rounds": PASSWORD_BCRYPT_ROUNDS,
+            "hashes": self.hashes,
+            "verifies": self.verifies,
+            "cache_size": len(self.verified),
+            "cache_hits": self.cache_hits,
+            "pending": self.pending,
+            "in_flight": sum(self.in_flight.values()),
+            "queued": self.limiter.waiting,
+            "rate_limited": self.limiter.rejected,
+            "busy_rejected": self.busy_rejected,
+        }
+
+
+password_hasher = PasswordHasher()
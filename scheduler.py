@@ -0,0 +1,241 @@
+import asyncio
+import heapq
+import math
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import select
+
+import models
+from camera_cache import camera_config
+from db_main import SessionLocal
+from occupancy import occupancy_snapshot
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0").lower() in ("1", "true", "yes")
+SCHEDULER_REFRESH = float(os.getenv("SCHEDULER_REFRESH", "60"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+SCHEDULER_MIN_INTERVAL = float(os.getenv("SCHEDULER_MIN_INTERVAL", "5"))
+SCHEDULER_MAX_INTERVAL = float(os.getenv("SCHEDULER_MAX_INTERVAL", "300"))
+SCHEDULER_DEFAULT_INTERVAL = float(os.getenv("SCHEDULER_DEFAULT_INTERVAL", "30"))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "0.1"))
+
+
+@dataclass
+class ScheduledCamera:
+    id: int
+    parking_lot_id: Optional[int]
+    url: str
+    backend: str
+    base_interval: float
+    interval: float
+    last_free: Optional[int] = None
+    due: float = 0.0
+    last_started: Optional[float] = None
+    last_finished: Optional[float] = None
+    last_lag: float = 0.0
+    max_lag: float = 0.0
+    captures: int = 0
+    errors: int = 0
+    running: bool = False
+
+
+class CaptureScheduler:
+    """
+    Captures every camera that has a "capture_url" in its config and sends
+    the frame down the normal ingestion path, each on its own interval.
+
+    The interval adapts to the lot when the result of a capture comes back
+    (`observe`, called from ingestion): when free_spots changed since the
+    previous result it halves (down to the minimum), when it stayed the same
+    it grows by half (up to the maximum), so busy lots are watched closely and
+    static or closed ones cost almost nothing. At most `concurrency`
+    captures run at once; cameras that are due while the budget is used up
+    wait, which shows up as lag.
+    """
+
+    def __init__(self, concurrency: int = SCHEDULER_CONCURRENCY, min_interval: float = SCHEDULER_MIN_INTERVAL,
+                 max_interval: float = SCHEDULER_MAX_INTERVAL, jitter: float = SCHEDULER_JITTER):
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.cameras: dict[int, ScheduledCamera] = {}
+        self.heap: list[tuple[float, int]] = []
+        self.grab = None
+        self.on_frame = None
+        self._tasks = []
+        self._running = set()
+        self._slots = None
+        self._wakeup = None
+
+    def _jittered(self, interval: float):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _push(self, camera: ScheduledCamera, due: float):
+        camera.due = due
+        heapq.heappush(self.heap, (due, camera.id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def refresh(self):
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(models.Cameras.id, models.Cameras.parking_lot_id, models.Cameras.config)
+            )).all()
+        seen = set()
+        now = time.monotonic()
+        for camera_id, parking_lot_id, config in rows:
+            config = camera_config(config)
+            url = config.get("capture_url")
+            if not url:
+                continue
+            seen.add(camera_id)
+            backend = config.get("capture_backend", "browser")
+            try:
+                base_interval = float(config.get("capture_interval", SCHEDULER_DEFAULT_INTERVAL))
+                if not math.isfinite(base_interval) or base_interval <= 0:
+                    raise ValueError(base_interval)
+            except (TypeError, ValueError):
+                # Одна камера с кривым интервалом не должна останавливать планирование остальных
+                print(f"Неверный capture_interval камеры {camera_id}: {config.get('capture_interval')!r}")
+                base_interval = SCHEDULER_DEFAULT_INTERVAL
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                camera = ScheduledCamera(camera_id, parking_lot_id, url, backend, base_interval, base_interval)
+                self.cameras[camera_id] = camera
+                # Разносим первые снимки по времени, чтобы не было толпы на старте
+                self._push(camera, now + random.uniform(0, min(base_interval, self.max_interval)))
+            else:
+                camera.parking_lot_id, camera.url, camera.backend = parking_lot_id, url, backend
+                if camera.base_interval != base_interval:
+                    camera.base_interval = camera.interval = base_interval
+                    self._reschedule(camera)
+        for camera_id in set(self.cameras) - seen:
+            # Из кучи запись уйдёт сама, когда наступит её время
+            del self.cameras[camera_id]
+
+    def _next_interval(self, camera: ScheduledCamera):
+        lots = occupancy_snapshot.lots
+        lot = lots.get(camera.parking_lot_id) if lots is not None else None
+        if lot is not None and not lot["capacity"]:
+            # Стоянка закрыта (вместимость 0) — снимаем редко
+            return self.max_interval
+        return camera.interval
+
+    def _reschedule(self, camera: ScheduledCamera):
+        # Во время съёмки новый срок поставит _run_camera; старая запись в куче пропустится по due
+        if not camera.running:
+            since = camera.last_finished if camera.last_finished is not None else time.monotonic()
+            self._push(camera, since + self._jittered(self._next_interval(camera)))
+
+    def observe(self, camera_id: int, free: int):
+        """Result of a frame of the camera (the lot's combined free_spots) is in."""
+        camera = self.cameras.get(camera_id)
+        if camera is None:
+            return
+        if camera.last_free is None:
+            interval = camera.base_interval
+        elif free != camera.last_free:
+            interval = camera.interval / 2
+        else:
+            interval = camera.interval * 1.5
+        camera.last_free = free
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if interval != camera.interval:
+            camera.interval = interval
+            self._reschedule(camera)
+
+    async def _run_camera(self, camera: ScheduledCamera):
+        camera.running = True
+        camera.last_started = time.monotonic()
+        try:
+            data = await self.grab(camera.id, camera.url, camera.backend)
+            await self.on_frame(camera.id, data)
+            camera.captures += 1
+        except Exception as e:
+            camera.errors += 1
+            print(f"Ошибка съёмки камеры {camera.id}: {str(e)}")
+        finally:
+            camera.running = False
+            camera.last_finished = time.monotonic()
+            self._slots.release()
+            if self.cameras.get(camera.id) is camera:
+                self._push(camera, camera.last_finished + self._jittered(self._next_interval(camera)))
+
+    async def _loop(self):
+        while True:
+            if not self.heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, camera_id = self.heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            camera = self.cameras.get(camera_id)
+            if camera is None or camera.due != due or camera.running:
+                continue
+            await self._slots.acquire()
+            camera.last_lag = time.monotonic() - due
+            camera.max_lag = max(camera.max_lag, camera.last_lag)
+            task = asyncio.create_task(self._run_camera(camera))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Ошибка обновления списка камер: {str(e)}")
+            await asyncio.sleep(SCHEDULER_REFRESH)
+
+    def start(self, grab, on_frame):
+        if self._tasks:
+            return
+        self.grab = grab
+        self.on_frame = on_frame
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._loop()), asyncio.create_task(self._refresh_loop())]
+
+    async def stop(self):
+        tasks = self._tasks + list(self._running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self.heap.clear()
+        self.cameras.clear()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "cameras": len(self.cameras),
+            "running": len(self._running),
+            "concurrency": self.concurrency,
+            "per_camera": {
+                camera.id: {
+                    "interval": camera.interval,
+                    "next_in": camera.due - now,
+                    "lag": camera.last_lag,
+                    "max_lag": camera.max_lag,
+                    "since_last": None if camera.last_finished is None else now - camera.last_finished,
+                    "captures": camera.captures,
+                    "errors": camera.errors,
+                }
+                for camera in self.cameras.values()
+            },
+        }
+
+
+capture_scheduler = CaptureScheduler()
@@ -0,0 +1,80 @@
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import or_
+
+import models
+from cluster import CLUSTER_MODE
+from db_main import upsert_insert
+
+FRAME_SEQ_SHARED = os.getenv("FRAME_SEQ_SHARED", "1" if CLUSTER_MODE else "0").lower() not in ("0", "false", "no")
+# Номер, отстающий от последнего больше чем на столько микросекунд, — не опоздавший кадр, а сброс отметки
+FRAME_SEQ_RESET = int(float(os.getenv("FRAME_SEQ_RESET", "300")) * 1_000_000)
+
+
+def next_seq() -> int:
+    # Номер кадра по времени приёма в микросекундах: монотонен между воркерами, пока часы синхронны
+    return time.time_ns() // 1000
+
+
+class FrameSequencer:
+    """
+    Drops frames that arrive out of order or twice. Each frame of a camera
+    carries a sequence number assigned by this server (`next_seq()`); a
+    frame whose number is not above the last accepted one for that camera is
+    rejected. A number more than `reset` below the last one (the clock was
+    set back, an old mark in the DB) is taken as a new start and accepted,
+    so a camera can't get stuck dropping everything. With `shared` the last
+    number lives in the camera_sequences table and is advanced with a
+    conditional upsert, so workers behind a load balancer agree on it; the
+    local copy only lets obvious repeats skip the DB.
+    """
+
+    def __init__(self, shared: bool = FRAME_SEQ_SHARED, reset: int = FRAME_SEQ_RESET):
+        self.shared = shared
+        self.reset = reset
+        self.last: dict[int, int] = {}
+        self.accepted = 0
+        self.dropped = 0
+
+    async def _claim(self, camera_id: int, seq: int, db) -> bool:
+        table = models.CameraSequences
+        stmt = upsert_insert()(table).values(camera_id=camera_id, seq=seq)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.camera_id],
+            set_={"seq": stmt.excluded.seq},
+            where=or_(table.seq < stmt.excluded.seq, table.seq > stmt.excluded.seq + self.reset),
+        ).returning(table.camera_id)
+        claimed = (await db.execute(stmt)).first() is not None
+        await db.commit()
+        return claimed
+
+    async def accept(self, camera_id: int, seq: Optional[int], db) -> bool:
+        if seq is None:
+            # Кадры без номера (старые клиенты) не проверяем
+            return True
+        last = self.last.get(camera_id)
+        if last is not None and last - self.reset <= seq <= last:
+            self.dropped += 1
+            return False
+        if self.shared and not await self._claim(camera_id, seq, db):
+            self.dropped += 1
+            return False
+        self.last[camera_id] = seq
+        self.accepted += 1
+        return True
+
+    def forget(self, camera_id: int):
+        self.last.pop(camera_id, None)
+
+    def stats(self):
+        return {
+            "shared": self.shared,
+            "cameras": len(self.last),
+            "accepted": self.accepted,
+            "dropped": self.dropped,
+        }
+
+
+frame_sequencer = FrameSequencer()
@@ -0,0 +1,270 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from cluster import CLUSTER_MODE
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "uploads"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+SNAPSHOT_STORE = os.getenv("SNAPSHOT_STORE", "local")
+SNAPSHOT_HISTORY = int(os.getenv("SNAPSHOT_HISTORY", "5"))
+SNAPSHOT_MEMORY_FRAMES = int(os.getenv("SNAPSHOT_MEMORY_FRAMES", "10"))
+SNAPSHOT_PRUNE_INTERVAL = float(os.getenv("SNAPSHOT_PRUNE_INTERVAL", "10"))
+
+
+@dataclass
+class Snapshot:
+    name: str
+    mtime: float
+    size: int
+    version: str
+    path: Optional[Path] = None
+    data: Optional[bytes] = None
+
+
+def latest_name(camera_id: int):
+    return f"camera_{camera_id}.jpg"
+
+
+def history_name(camera_id: int, seq: int):
+    return f"camera_{camera_id}.{seq}.jpg"
+
+
+def file_version(stat: os.stat_result) -> str:
+    # Переименование создаёт новый inode, так что версия меняется с каждым кадром
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def is_safe_name(name: str):
+    # Только имя файла внутри хранилища, без каталогов и скрытых/временных файлов
+    return bool(name) and Path(name).name == name and not name.startswith(".")
+
+
+class SnapshotStore(ABC):
+    """
+    Where camera frames are kept. `save` stores the latest frame of a camera
+    (and a short history), `load` returns a frame by its public name.
+    """
+
+    def __init__(self):
+        self.last_saved: dict[int, float] = {}
+        self.intervals: dict[int, float] = {}
+
+    def _record(self, camera_id: int):
+        # Сглаженный интервал между кадрами камеры, нужен для Cache-Control
+        now = time.time()
+        last = self.last_saved.get(camera_id)
+        if last is not None:
+            interval = now - last
+            previous = self.intervals.get(camera_id)
+            self.intervals[camera_id] = interval if previous is None else 0.7 * previous + 0.3 * interval
+        self.last_saved[camera_id] = now
+
+    def interval(self, camera_id: int) -> Optional[float]:
+        return self.intervals.get(camera_id)
+
+    @abstractmethod
+    async def save(self, camera_id: int, upload: UploadFile) -> Snapshot:
+        ...
+
+    @abstractmethod
+    async def load(self, name: str) -> Optional[Snapshot]:
+        ...
+
+    @abstractmethod
+    def history(self, camera_id: int) -> list[str]:
+        ...
+
+
+class LocalSnapshotStore(SnapshotStore):
+    """
+    Frames on the local filesystem. All file work runs in the threadpool;
+    each frame is written to a temp file and renamed into place, so readers
+    only ever see complete files. The last `history` frames of each camera
+    are kept next to the latest one, older ones are deleted. With `shared`
+    (several workers writing into one directory) no process sees the whole
+    history, so instead of pruning on every frame a background sweep over
+    the directory, at most once per `prune_interval`, trims every camera.
+    """
+
+    def __init__(self, root: Path = UPLOAD_DIR, history: int = SNAPSHOT_HISTORY, shared: bool = CLUSTER_MODE,
+                 prune_interval: float = SNAPSHOT_PRUNE_INTERVAL):
+        super().__init__()
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.history_size = history
+        self.shared = shared
+        self.prune_interval = prune_interval
+        self._history: dict[int, deque] = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._last_sweep = 0.0
+        self._sweeping = False
+
+    def _scan_history(self, camera_id: int):
+        return sorted(
+            (p.name for p in self.root.glob(f"camera_{camera_id}.*.jpg")),
+            key=lambda name: int(name.split(".")[1]) if name.split(".")[1].isdigit() else 0,
+        )
+
+    def _camera_history(self, camera_id: int):
+        camera_history = self._history.get(camera_id)
+        if camera_history is None:
+            # Подхватываем историю, оставшуюся после перезапуска
+            camera_history = self._history[camera_id] = deque(self._scan_history(camera_id))
+        return camera_history
+
+    def _sweep(self):
+        # Один проход по каталогу на все камеры, без блокировки: чужие воркеры пишут параллельно
+        try:
+            by_camera: dict[str, list] = {}
+            with os.scandir(self.root) as entries:
+                for entry in entries:
+                    parts = entry.name.split(".")
+                    if len(parts) == 3 and parts[0].startswith("camera_") and parts[1].isdigit() and parts[2] == "jpg":
+                        by_camera.setdefault(parts[0], []).append((int(parts[1]), entry.name))
+            for names in by_camera.values():
+                names.sort()
+                for _, name in names[:-self.history_size]:
+                    (self.root / name).unlink(missing_ok=True)
+        finally:
+            self._sweeping = False
+
+    def _maybe_sweep(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._sweeping or now - self._last_sweep < self.prune_interval:
+                return
+            self._sweeping = True
+            self._last_sweep = now
+        threading.Thread(target=self._sweep, name="snapshot-sweep", daemon=True).start()
+
+    def _next_seq(self):
+        with self._lock:
+            self._seq = max(self._seq + 1, time.time_ns() // 1000)
+            return self._seq
+
+    def _write(self, camera_id: int, source) -> Snapshot:
+        target = self.root / latest_name(camera_id)
+        tmp = tempfile.NamedTemporaryFile(dir=self.root, prefix=f".{target.name}.", suffix=".tmp", delete=False)
+        try:
+            with tmp:
+                source.seek(0)
+                shutil.copyfileobj(source, tmp, UPLOAD_CHUNK_SIZE)
+            if self.history_size > 0:
+                # Кадр истории — жёсткая ссылка на тот же файл, без лишнего копирования
+                while True:
+                    history_path = self.root / history_name(camera_id, self._next_seq())
+                    try:
+                        os.link(tmp.name, history_path)
+                    except FileExistsError:
+                        # Тот же номер только что занял другой воркер
+                        continue
+                    except OSError:
+                        shutil.copyfile(tmp.name, history_path)
+                    break
+                os.replace(tmp.name, target)
+                if self.shared:
+                    self._maybe_sweep()
+                else:
+                    with self._lock:
+                        camera_history = self._camera_history(camera_id)
+                        # Первое обращение к камере сканирует каталог и уже видит только что созданную ссылку
+                        if history_path.name not in camera_history:
+                            camera_history.append(history_path.name)
+                        expired = [camera_history.popleft() for _ in range(len(camera_history) - self.history_size)]
+                    for name in expired:
+                        (self.root / name).unlink(missing_ok=True)
+            else:
+                os.replace(tmp.name, target)
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+        return self._stat(target.name)
+
+    async def save(self, camera_id: int, upload: UploadFile) -> Snapshot:
+        snapshot = await run_in_threadpool(self._write, camera_id, upload.file)
+        self._record(camera_id)
+        return snapshot
+
+    def _stat(self, name: str):
+        path = self.root / name
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        if not path.is_file():
+            return None
+        return Snapshot(name, stat.st_mtime, stat.st_size, file_version(stat), path=path)
+
+    async def load(self, name: str) -> Optional[Snapshot]:
+        if not is_safe_name(name):
+            return None
+        return await run_in_threadpool(self._stat, name)
+
+    def history(self, camera_id: int) -> list[str]:
+        if self.shared:
+            # До следующей чистки на диске может лежать чуть больше кадров
+            return self._scan_history(camera_id)[-self.history_size:] if self.history_size > 0 else []
+        with self._lock:
+            return list(self._camera_history(camera_id))
+
+
+class MemorySnapshotStore(SnapshotStore):
+    """
+    Keeps the last `frames` frames of each camera in memory only.
+    Useful for replay/debugging or when disk is not wanted at all.
+    """
+
+    def __init__(self, frames: int = SNAPSHOT_MEMORY_FRAMES):
+        super().__init__()
+        self.frames = max(frames, 1)
+        self.rings: dict[int, deque] = {}
+        self.by_name: dict[str, Snapshot] = {}
+        self._seq = 0
+
+    def _read(self, source):
+        source.seek(0)
+        return source.read()
+
+    async def save(self, camera_id: int, upload: UploadFile) -> Snapshot:
+        data = await run_in_threadpool(self._read, upload.file)
+        self._seq = max(self._seq + 1, time.time_ns() // 1000)
+        now = time.time()
+        snapshot = Snapshot(history_name(camera_id, self._seq), now, len(data), str(self._seq), data=data)
+        ring = self.rings.setdefault(camera_id, deque())
+        ring.append(snapshot)
+        self.by_name[snapshot.name] = snapshot
+        while len(ring) > self.frames:
+            self.by_name.pop(ring.popleft().name, None)
+        latest = Snapshot(latest_name(camera_id), now, len(data), str(self._seq), data=data)
+        self.by_name[latest.name] = latest
+        self._record(camera_id)
+        return latest
+
+    async def load(self, name: str) -> Optional[Snapshot]:
+        return self.by_name.get(name)
+
+    def history(self, camera_id: int) -> list[str]:
+        return [snapshot.name for snapshot in self.rings.get(camera_id, ())]
+
+
+def make_snapshot_store(kind: str = SNAPSHOT_STORE) -> SnapshotStore:
+    if kind == "memory":
+        return MemorySnapshotStore()
+    if kind == "local":
+        return LocalSnapshotStore()
+    raise ValueError(f"Unknown SNAPSHOT_STORE: {kind}")
+
+
+snapshot_store = make_snapshot_store()
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+import time
+
+STREAM_CLIENT_BUFFER = int(os.getenv("STREAM_CLIENT_BUFFER", "100"))
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
+
+
+def parse_lots(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    return {int(lot_id) for lot_id in value}
+
+
+def parse_bbox(value):
+    # bbox = min_lat,min_lon,max_lat,max_lon
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    bbox = tuple(float(v) for v in value)
+    if len(bbox) != 4:
+        raise ValueError("bbox must be min_lat,min_lon,max_lat,max_lon")
+    return bbox
+
+
+class Subscriber:
+    """
+    One connected client. Deltas go into a bounded queue; when the client
+    can't keep up the oldest delta is dropped so ingestion never waits.
+    """
+
+    def __init__(self, lots=None, bbox=None, buffer: int = STREAM_CLIENT_BUFFER):
+        self.lots = lots
+        self.bbox = bbox
+        self.queue = asyncio.Queue(maxsize=buffer)
+        self.dropped = 0
+
+    def wants(self, lot: dict):
+        if self.lots is not None and lot["id"] not in self.lots:
+            return False
+        if self.bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if lot["latitude"] is None or lot["longitude"] is None:
+                return False
+            if not (min_lat <= lot["latitude"] <= max_lat and min_lon <= lot["longitude"] <= max_lon):
+                return False
+        return True
+
+    def push(self, delta: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(delta)
+
+
+class OccupancyStream:
+    def __init__(self):
+        self.subscribers: set[Subscriber] = set()
+        self.published = 0
+
+    def subscribe(self, lots=None, bbox=None):
+        subscriber = Subscriber(lots, bbox)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, lot: dict):
+        if not self.subscribers:
+            return
+        delta = {
+            "id": lot["id"],
+            "free_spots": lot["free_spots"],
+            "capacity": lot["capacity"],
+            "ts": time.time(),
+        }
+        self.published += 1
+        for subscriber in self.subscribers:
+            if subscriber.wants(lot):
+                subscriber.push(delta)
+
+    async def sse_events(self, subscriber: Subscriber, request):
+        try:
+            while not await request.is_disconnected():
+                try:
+                    delta = await asyncio.wait_for(subscriber.queue.get(), timeout=STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: occupancy\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": sum(subscriber.dropped for subscriber in self.subscribers),
+        }
+
+
+occupancy_stream = OccupancyStream()
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import random
+import shutil
+import time
+
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+STREAM_DECODERS = int(os.getenv("STREAM_DECODERS", str(os.cpu_count() or 2)))
+STREAM_TIMEOUT = float(os.getenv("STREAM_TIMEOUT", "20"))
+STREAM_JPEG_QUALITY = int(os.getenv("STREAM_JPEG_QUALITY", "3"))
+STREAM_READ_SIZE = 64 * 1024
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+
+
+def ffmpeg_args(url: str, keyframes_only: bool, interval=None, frames=None):
+    args = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin"]
+    if url.startswith("rtsp://"):
+        args += ["-rtsp_transport", "tcp"]
+    if keyframes_only:
+        # Декодируем только ключевые кадры — в разы меньше CPU на поток
+        args += ["-skip_frame", "nokey"]
+    args += ["-i", url, "-an", "-sn", "-dn"]
+    if interval:
+        args += ["-vf", f"fps=1/{interval}"]
+    if frames:
+        args += ["-frames:v", str(frames)]
+    args += ["-fps_mode", "passthrough", "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", str(STREAM_JPEG_QUALITY), "pipe:1"]
+    return args
+
+
+def split_jpegs(buffer: bytearray):
+    # ffmpeg пишет JPEG подряд без разделителей, режем по маркерам SOI/EOI
+    frames = []
+    while True:
+        start = buffer.find(SOI)
+        if start < 0:
+            buffer.clear()
+            return frames
+        end = buffer.find(EOI, start + 2)
+        if end < 0:
+            del buffer[:start]
+            return frames
+        frames.append(bytes(buffer[start:end + 2]))
+        del buffer[:end + 2]
+
+
+class StreamGrabber:
+    """
+    Capture backend for cameras with a direct HLS/MJPEG/RTSP URL. Frames are
+    decoded by ffmpeg subprocesses writing JPEGs to a pipe, no browser is
+    involved. Every decoder is its own OS process, so decoding spreads across
+    cores; one-off captures are capped at `decoders` at once (one per core by
+    default), watched cameras keep one long-lived decoder each.
+    """
+
+    def __init__(self, decoders: int = STREAM_DECODERS):
+        self.decoders = decoders
+        self._semaphore = None
+        self.watches: dict[int, asyncio.Task] = {}
+        self.processes: dict[int, asyncio.subprocess.Process] = {}
+        self.last_capture: dict[int, float] = {}
+        self.captures = 0
+        self.errors = 0
+        self.restarts = 0
+
+    @staticmethod
+    def available():
+        return shutil.which(FFMPEG_BIN) is not None
+
+    def _slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.decoders)
+        return self._semaphore
+
+    async def capture(self, camera_id: int, url: str, keyframes_only: bool = True) -> bytes:
+        async with self._slot():
+            process = await asyncio.create_subprocess_exec(
+                *ffmpeg_args(url, keyframes_only, frames=1),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=STREAM_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                self.errors += 1
+                raise RuntimeError("ffmpeg timed out")
+        frames = split_jpegs(bytearray(stdout))
+        if process.returncode != 0 or not frames:
+            self.errors += 1
+            raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()[-300:]}")
+        self.captures += 1
+        self.last_capture[camera_id] = time.time()
+        return frames[0]
+
+    def watch(self, camera_id: int, url: str, interval: float, on_frame, keyframes_only: bool = True):
+        self.unwatch(camera_id)
+        self.watches[camera_id] = asyncio.create_task(self._watch(camera_id, url, interval, on_frame, keyframes_only))
+
+    def unwatch(self, camera_id: int):
+        task = self.watches.pop(camera_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def release(self, camera_id: int):
+        self.unwatch(camera_id)
+        self.last_capture.pop(camera_id, None)
+
+    async def _watch(self, camera_id: int, url: str, interval: float, on_frame, keyframes_only: bool):
+        # Один долгоживущий ffmpeg на камеру: соединение с потоком не переоткрывается
+        # на каждый кадр, а фильтр fps сам прореживает кадры до нужного интервала
+        await asyncio.sleep(random.uniform(0, min(interval, 5)))
+        backoff = 1.0
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                *ffmpeg_args(url, keyframes_only, interval=interval),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            )
+            self.processes[camera_id] = process
+            buffer = bytearray()
+            try:
+                while chunk := await process.stdout.read(STREAM_READ_SIZE):
+                    buffer += chunk
+                    for frame in split_jpegs(buffer):
+                        backoff = 1.0
+                        self.captures += 1
+                        self.last_capture[camera_id] = time.time()
+                        try:
+                            await on_frame(camera_id, frame)
+                        except Exception as e:
+                            print(f"Ошибка обработки кадра камеры {camera_id}: {str(e)}")
+            finally:
+                self.processes.pop(camera_id, None)
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            # Поток оборвался — переподключаемся с нарастающей задержкой
+            self.restarts += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    async def stop(self):
+        tasks = list(self.watches.values())
+        for camera_id in list(self.watches):
+            self.unwatch(camera_id)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        now = time.time()
+        return {
+            "available": self.available(),
+            "decoders": self.decoders,
+            "running": len(self.processes),
+            "watched": len(self.watches),
+            "captures": self.captures,
+            "errors": self.errors,
+            "restarts": self.restarts,
+            "staleness": {camera_id: now - ts for camera_id, ts in self.last_capture.items()},
+        }
+
+
+stream_grabber = StreamGrabber()
@@ -0,0 +1,147 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, Request, Response, status
+
+from images import ImageCache, image_headers, is_not_modified
+from snapshots import Snapshot, SnapshotStore, file_version
+
+try:
+    from PIL import Image
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+THUMB_WIDTHS = sorted(int(w) for w in os.getenv("THUMB_WIDTHS", "").split(",") if w.strip()) or [160, 320, 640, 1280]
+THUMB_DEFAULT_QUALITY = int(os.getenv("THUMB_DEFAULT_QUALITY", "75"))
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+THUMB_CACHE_BYTES = int(os.getenv("THUMB_CACHE_BYTES", str(32 * 1024 * 1024)))
+# Ширины, которые рендерятся сразу для каждого нового кадра; пустое значение отключает
+THUMB_PREGENERATE = [int(w) for w in os.getenv("THUMB_PREGENERATE", "320").split(",") if w.strip()]
+
+
+def pick_width(width: int):
+    # Только фиксированный набор ширин, чтобы кэш не раздувался от произвольных ?w=
+    for allowed in THUMB_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return THUMB_WIDTHS[-1]
+
+
+def pick_quality(quality):
+    if quality is None:
+        return THUMB_DEFAULT_QUALITY
+    return min(max(int(quality), 10), 95)
+
+
+def render(source, width: int, quality: int) -> bytes:
+    with Image.open(source) as image:
+        image.draft("RGB", (width, width))
+        if image.width > width:
+            height = max(round(image.height * width / image.width), 1)
+            image = image.resize((width, height), Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def render_snapshot(snapshot: Snapshot, width: int, quality: int):
+    if snapshot.data is not None:
+        return snapshot.version, render(io.BytesIO(snapshot.data), width, quality)
+    # Файл открывается один раз: версия и картинка берутся от одного inode,
+    # даже если кадр заменили между load() и рендером
+    with open(snapshot.path, "rb") as source:
+        return file_version(os.fstat(source.fileno())), render(source, width, quality)
+
+
+class ThumbnailService:
+    """
+    Downscaled JPEG variants of snapshots. Each (image, version, width,
+    quality) is rendered once in a worker pool off the event loop and kept
+    in a size-bounded LRU; concurrent requests for the same variant share
+    one render.
+    """
+
+    def __init__(self, workers: int = THUMB_WORKERS, cache_bytes: int = THUMB_CACHE_BYTES):
+        self.workers = workers
+        self.executor = None
+        self.tasks = set()
+        self.cache = ImageCache(max_bytes=cache_bytes, max_item=cache_bytes)
+        self.pending: dict[tuple, asyncio.Future] = {}
+        self.rendered = 0
+
+    async def get(self, name: str, snapshot: Snapshot, width: int, quality: int) -> bytes:
+        key = f"{name}?w={width}&q={quality}"
+        data = self.cache.get(key, snapshot.version)
+        if data is not None:
+            return data
+        pending_key = (key, snapshot.version)
+        future = self.pending.get(pending_key)
+        if future is None:
+            if self.executor is None:
+                self.start()
+            future = asyncio.get_running_loop().run_in_executor(self.executor, render_snapshot, snapshot, width, quality)
+            self.pending[pending_key] = future
+            future.add_done_callback(lambda f: self._done(key, pending_key, f))
+        # shield: отмена одного клиента не должна отменять общий рендер
+        _, data = await asyncio.shield(future)
+        return data
+
+    def _done(self, key: str, pending_key: tuple, future: asyncio.Future):
+        self.pending.pop(pending_key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.rendered += 1
+        # Кэшируем под версией того файла, который на самом деле отрендерили
+        version, data = future.result()
+        self.cache.put(key, version, data)
+
+    def schedule(self, name: str, snapshot: Snapshot):
+        # Заранее готовим превью нового кадра, не задерживая ответ камере
+        if not THUMB_PREGENERATE or not PILLOW_AVAILABLE:
+            return
+        task = asyncio.create_task(self.pregenerate(name, snapshot))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def pregenerate(self, name: str, snapshot: Snapshot):
+        for width in THUMB_PREGENERATE:
+            try:
+                await self.get(name, snapshot, pick_width(width), THUMB_DEFAULT_QUALITY)
+            except Exception as e:
+                print(f"Ошибка генерации превью {name}: {e}")
+                return
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumb")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self):
+        return {**self.cache.stats(), "rendered": self.rendered, "in_progress": len(self.pending)}
+
+
+thumbnail_service = ThumbnailService()
+
+
+async def thumbnail_response(request: Request, name: str, snapshot: Snapshot, store: SnapshotStore,
+                             width: int, quality=None):
+    if not PILLOW_AVAILABLE:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Thumbnails are not available")
+    width, quality = pick_width(width), pick_quality(quality)
+    headers = image_headers(name, snapshot, store, f'"{snapshot.version}-w{width}-q{quality}"')
+    if is_not_modified(request, headers["ETag"], snapshot.mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        data = await thumbnail_service.get(name, snapshot, width, quality)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image")
+    return Response(content=data, media_type="image/jpeg", headers=headers)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from jose import jwt, JWTError
+from sqlalchemy import select
+
+import models
+from db_main import SessionLocal
+
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+JWT_USER_CACHE_SIZE = int(os.getenv("JWT_USER_CACHE_SIZE", "10000"))
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def encode_token(claims: dict, secret: str, algorithm: str) -> str:
+    return jwt.encode(claims, secret, algorithm=algorithm)
+
+
+def decode_token(token: str, secret: str, algorithm: str) -> dict:
+    try:
+        return jwt.decode(token, secret, algorithms=[algorithm])
+    except JWTError as e:
+        raise InvalidToken(str(e))
+
+
+@dataclass
+class CachedToken:
+    user: dict
+    user_id: int
+    exp: float
+
+
+@dataclass
+class UserState:
+    version: int
+    is_superior: bool
+
+
+class TokenCache:
+    """
+    LRU of already verified JWTs keyed by a hash of the token, so a repeated
+    token skips signature checking and decoding until its `exp`. Tokens carry
+    the user's role ("sup") and token version ("ver"); a token whose version
+    is behind the user's current one (bumped on user update/delete) is
+    rejected. User versions are read from the DB once per user and kept in
+    a second LRU of `max_users`; unknown users are not cached.
+    """
+
+    def __init__(self, max_size: int = JWT_CACHE_SIZE, max_users: int = JWT_USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.max_users = max_users
+        self.entries: OrderedDict[bytes, CachedToken] = OrderedDict()
+        self.users: OrderedDict[int, UserState] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revoked = 0
+
+    async def _user_state(self, user_id: int) -> Optional[UserState]:
+        state = self.users.get(user_id)
+        if state is not None:
+            self.users.move_to_end(user_id)
+            return state
+        async with SessionLocal() as db:
+            row = (await db.execute(
+                select(models.Users.token_version, models.Users.is_superior).where(models.Users.id == user_id)
+            )).first()
+        if row is None:
+            # Промахи не кэшируем: id из чужих токенов не должны забивать кэш
+            return None
+        state = self.users[user_id] = UserState(row[0] or 0, bool(row[1]))
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+        return state
+
+    async def validate(self, token: str, secret: str, algorithm: str) -> dict:
+        key = hashlib.blake2b(token.encode(), digest_size=20).digest()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry.exp > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry.user
+            del self.entries[key]
+        self.misses += 1
+        payload = decode_token(token, secret, algorithm)
+        username = payload.get('sub')
+        user_id = payload.get('id')
+        if username is None or user_id is None:
+            raise InvalidToken("missing claims")
+        state = await self._user_state(user_id)
+        if state is None or payload.get('ver', 0) != state.version:
+            self.revoked += 1
+            raise InvalidToken("token revoked")
+        # В старых токенах роли нет — берём её из БД
+        user = {'username': username, 'id': user_id, 'is_superior': payload.get('sup', state.is_superior)}
+        self.entries[key] = CachedToken(user, user_id, float(payload.get('exp', 0)))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return user
+
+    def revoke_user(self, user_id: int):
+        # Следующая проверка перечитает версию пользователя из БД
+        self.users.pop(user_id, None)
+        for key in [key for key, entry in self.entries.items() if entry.user_id == user_id]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.users.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "users": len(self.users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revoked": self.revoked,
+        }
+
+
+token_cache = TokenCache()